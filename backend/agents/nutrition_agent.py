@@ -2,10 +2,11 @@
 import os
 import logging
 from dotenv import load_dotenv
-from langchain_community.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+from fastapi import HTTPException
 from scopes import NUTRITION_DIETPLAN
 from auth import verify_descope_token
+from utils.model_router import invoke_agent_llm
+from utils.prompt_builder import register_prompt
 import re  # For sanitization
 
 load_dotenv()
@@ -13,7 +14,8 @@ OPENAI_API_KEY = os.environ["OPENAI_API_KEY_TRAIN_NUTRI"]
 
 logging.basicConfig(level=logging.INFO)
 
-system_prompt = SystemMessagePromptTemplate.from_template(
+nutrition_prompt = register_prompt(
+    "nutrition",
     "You are a professional nutrition expert. Provide concise, accurate advice on diet, macros, vitamins, minerals, and fitness-focused nutrition. You can also give a diet plan "
     "Respond only with information directly related to food, diet, calories, protein, carbohydrates, fats, micronutrients, hydration, and meal timing. "
     "Do NOT provide detailed exercise, workout, or training plans—that is handled by the Trainer Agent. "
@@ -26,9 +28,6 @@ system_prompt = SystemMessagePromptTemplate.from_template(
 )
 
 
-user_prompt_template = HumanMessagePromptTemplate.from_template("{user_query}")
-chat_prompt = ChatPromptTemplate.from_messages([system_prompt, user_prompt_template])
-
 # Utility to sanitize chat content
 def sanitize_text(text: str) -> str:
     # Remove only asterisks (*) and hashtags (#)
@@ -50,20 +49,15 @@ async def nutrition_node(state: dict, context: dict) -> dict:
 
     try:
         await verify_descope_token(token, NUTRITION_DIETPLAN)
-    except Exception as e:
-        state["nutrition_response"] = f"⛔ Unauthorized: {str(e)}"
+    except HTTPException as e:
+        # Only a scope/token denial is "Unauthorized"; a Descope outage propagates as UpstreamUnavailable
+        state["nutrition_response"] = f"⛔ Unauthorized: {e.detail}"
         return state
 
-    # Combine sanitized chat history into user query
-    history_text = ""
-    if chat_history:
-        sanitized_history = [sanitize_text(msg.get("content", "")) for msg in chat_history]
-        history_text = "\n".join(f"User: {h}" for h in sanitized_history)
-        user_query = f"{history_text}\nUser: {sanitize_text(user_query)}"
-
-    llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.7, openai_api_key=OPENAI_API_KEY)
-    messages = chat_prompt.format_messages(user_query=user_query)
-    response = await llm.ainvoke(messages)
+    # History goes in as separate turns after the fixed system prompt, so the prompt prefix stays cacheable
+    history = [{"role": m.get("role", "user"), "content": sanitize_text(m.get("content", ""))} for m in chat_history]
+    prompt = nutrition_prompt.build(history=history, user_query=sanitize_text(user_query))
+    response = await invoke_agent_llm("nutrition", state, prompt, OPENAI_API_KEY)
     response_text = sanitize_text(response.content)
     state["nutrition_response"] = response_text
 
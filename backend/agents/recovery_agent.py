@@ -2,34 +2,77 @@
 import os
 import logging
 from dotenv import load_dotenv
-from langchain_community.chat_models import ChatOpenAI
-from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
+from fastapi import HTTPException
 from scopes import RECOVERY_COLLECT, RECOVERY_INVOKE_TRAINER, RECOVERY_INVOKE_NUTRITION
 from auth import verify_descope_token
+from utils.resilience import AGENT_UNAVAILABLE_MESSAGE, UpstreamUnavailable, call_with_resilience
+from utils.llm_cassette import CassetteMiss
+from utils.model_router import invoke_agent_llm
+from utils.prompt_builder import register_prompt
+from utils.profiling import profile_span
+from utils.shared_cache import get_cache
 import re
 import httpx
 import datetime
+import hashlib
 from typing import Dict
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Fitbit's daily metrics change slowly, so fetched metrics are shared across workers for a few minutes
+FITBIT_CACHE_TTL_SECONDS = float(os.getenv("FITBIT_CACHE_TTL_SECONDS", "300"))
+_fitbit_cache = get_cache("fitbit_metrics", default_ttl=FITBIT_CACHE_TTL_SECONDS)
+# Fitbit rate limits are per user: a rate-limited token is left alone until its Retry-After passes
+FITBIT_DEFAULT_RETRY_AFTER_SECONDS = 60
+_fitbit_cooldowns = get_cache("fitbit_cooldown", default_ttl=FITBIT_DEFAULT_RETRY_AFTER_SECONDS)
 logging.basicConfig(level=logging.INFO)
 
-# System & user prompt templates
-system_prompt = SystemMessagePromptTemplate.from_template(
+# The metrics and advice for a call go in as per-call context after the history, not in the system prompt
+recovery_prompt = register_prompt(
+    "recovery",
     "You are a professional and empathetic advisor for recovery, nutrition, and fitness. "
     "Provide clear and actionable advice based on user inputs and health data. "
     "Respond in a human-like style. Keep responses safe and avoid disclosing sensitive info. "
     "No emojis, symbols or asterisks."
 )
-user_prompt = HumanMessagePromptTemplate.from_template("{user_query}")
-chat_prompt = ChatPromptTemplate.from_messages([system_prompt, user_prompt])
 
 
 def sanitize_text(text: str):
     return re.sub(r"[*#]", "", text)
 
 
+class FitbitRateLimited(Exception):
+    """Fitbit returned 429 for this user's token."""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Fitbit rate limit reached; retry in {retry_after:.0f}s")
+
+
+def _retry_after(resp: httpx.Response) -> float:
+    try:
+        return min(3600.0, max(1.0, float(resp.headers["Retry-After"])))
+    except (KeyError, ValueError):
+        return FITBIT_DEFAULT_RETRY_AFTER_SECONDS
+
+
+async def fitbit_get(client: httpx.AsyncClient, url: str, headers: dict, timeout: float = 10):
+    """
+    GET a Fitbit endpoint behind the shared Fitbit circuit breaker; 5xx count as failures.
+    A 429 is one user's rate limit, not an outage: it raises FitbitRateLimited, which is
+    neither retried nor counted against the breaker.
+    """
+    async def call():
+        resp = await client.get(url, headers=headers, timeout=timeout)
+        if resp.status_code == 429:
+            raise FitbitRateLimited(_retry_after(resp))
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        return resp
+    with profile_span("fitbit", httpx.URL(url).path):
+        return await call_with_resilience("fitbit", call)
+
+
 async def fetch_fitbit_data(fitbit_token: str):
     """
     Fetch Fitbit data with detailed logging. Returns a dict of all available metrics.
@@ -44,37 +87,46 @@ async def fetch_fitbit_data(fitbit_token: str):
         "water_ml": None, "weight": None, "resting_hr": None, "hr_zones": None
     }
 
+    token_key = hashlib.sha256(fitbit_token.encode("utf-8")).hexdigest()
+    if await _fitbit_cooldowns.get(token_key):
+        logging.info("[Fitbit] Skipping fetch, token is rate limited")
+        return user_metrics
+
     try:
         async with httpx.AsyncClient() as client:
             today = datetime.date.today()
 
             # --- Sleep ---
             try:
-                resp = await client.get(f"https://api.fitbit.com/1.2/user/-/sleep/date/{today}.json", headers=headers)
-                logging.info(f"[Fitbit][Sleep] Status: {resp.status_code}, Response: {resp.text}")
+                resp = await fitbit_get(client, f"https://api.fitbit.com/1.2/user/-/sleep/date/{today}.json", headers)
+                logging.info("[Fitbit][Sleep] Status: %s", resp.status_code)
                 if resp.status_code == 200:
                     data = resp.json()
                     total_minutes = sum(s.get("minutesAsleep", s.get("duration",0)/60000) for s in data.get("sleep", []))
                     user_metrics["sleep_hours"] = total_minutes / 60 if total_minutes > 0 else None
                     user_metrics["sleep_efficiency"] = data["sleep"][0].get("efficiency") if data.get("sleep") else None
+            except FitbitRateLimited:
+                raise
             except Exception as e:
                 logging.warning(f"[Fitbit][Sleep] Exception: {e}")
 
             # --- Profile ---
             try:
-                resp = await client.get("https://api.fitbit.com/1/user/-/profile.json", headers=headers, timeout=10)
-                logging.info(f"[Fitbit][Profile] Status: {resp.status_code}, Response: {resp.text}")
+                resp = await fitbit_get(client, "https://api.fitbit.com/1/user/-/profile.json", headers)
+                logging.info("[Fitbit][Profile] Status: %s", resp.status_code)
                 if resp.status_code == 200:
                     prof = resp.json().get("user", {})
                     user_metrics["username"] = prof.get("displayName")
                     user_metrics["weight"] = float(prof.get("weight",0)) if prof.get("weight") else None
+            except FitbitRateLimited:
+                raise
             except Exception as e:
                 logging.warning(f"[Fitbit][Profile] Exception: {e}")
 
             # --- Activity ---
             try:
-                resp = await client.get(f"https://api.fitbit.com/1/user/-/activities/date/{today}.json", headers=headers, timeout=10)
-                logging.info(f"[Fitbit][Activity] Status: {resp.status_code}, Response: {resp.text}")
+                resp = await fitbit_get(client, f"https://api.fitbit.com/1/user/-/activities/date/{today}.json", headers)
+                logging.info("[Fitbit][Activity] Status: %s", resp.status_code)
                 if resp.status_code == 200:
                     summary = resp.json().get("summary", {})
                     user_metrics["calories_burned"] = int(summary.get("caloriesOut",0))
@@ -83,6 +135,8 @@ async def fetch_fitbit_data(fitbit_token: str):
                     if distances:
                         user_metrics["distance"] = float(next((d.get("distance") for d in distances if d.get("activity")=="total"), 0))
                     user_metrics["active_minutes"] = int(summary.get("fairlyActiveMinutes",0)) + int(summary.get("veryActiveMinutes",0))
+            except FitbitRateLimited:
+                raise
             except Exception as e:
                 logging.warning(f"[Fitbit][Activity] Exception: {e}")
 
@@ -94,15 +148,33 @@ async def fetch_fitbit_data(fitbit_token: str):
             }
             for key, url in endpoints.items():
                 try:
-                    resp = await client.get(url, headers=headers, timeout=10)
-                    logging.info(f"[Fitbit][{key.capitalize()}] Status: {resp.status_code}, Response: {resp.text}")
+                    resp = await fitbit_get(client, url, headers)
+                    logging.info("[Fitbit][%s] Status: %s", key.capitalize(), resp.status_code)
+                except FitbitRateLimited:
+                    raise
                 except Exception as e:
                     logging.warning(f"[Fitbit][{key.capitalize()}] Exception: {e}")
 
+    except FitbitRateLimited as e:
+        # Stop at the first 429 and keep what was fetched; later requests skip Fitbit until Retry-After
+        logging.warning("[Fitbit] %s", e)
+        await _fitbit_cooldowns.set(token_key, True, ttl=e.retry_after)
     except Exception as e:
         logging.warning(f"[Fitbit] Overall fetch failed: {e}")
 
-    logging.info(f"[RecoveryAgent] Final metrics: {user_metrics}")
+    logging.info("[RecoveryAgent] Fitbit metrics available: %s", [k for k, v in user_metrics.items() if v is not None])
+    return user_metrics
+
+
+async def get_fitbit_data(fitbit_token: str):
+    """fetch_fitbit_data through the shared cache, so workers and repeat turns reuse today's metrics."""
+    key = hashlib.sha256(fitbit_token.encode("utf-8")).hexdigest()
+    cached = await _fitbit_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+    user_metrics = await fetch_fitbit_data(fitbit_token)
+    if any(v is not None for v in user_metrics.values()):
+        await _fitbit_cache.set(key, user_metrics)
     return user_metrics
 
 
@@ -123,8 +195,8 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
 
     try:
         await verify_descope_token(token, RECOVERY_COLLECT)
-    except Exception as e:
-        state["recovery_response"] = f"Unauthorized: {str(e)}"
+    except HTTPException as e:
+        state["recovery_response"] = f"Unauthorized: {e.detail}"
         return state
 
     defaults = {"sleep_hours":7, "protein":50, "mood":7, "diet_quality":7, "weight":70}
@@ -133,7 +205,7 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
     fitbit_data = {}
     fitbit_linked = state.get("fitbit_linked", False)
     if fitbit_token and fitbit_linked:
-        fitbit_data = await fetch_fitbit_data(fitbit_token)
+        fitbit_data = await get_fitbit_data(fitbit_token)
         for key, val in fitbit_data.items():
             if val is not None:
                 state[f"fitbit_{key}"] = val
@@ -164,14 +236,16 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
     if user_query:
         combined_query += f"\nUser: {sanitize_text(user_query)}"
 
+    def build_prompt(context: str):
+        history = [{"role": m.get("role", "user"), "content": sanitize_text(m.get("content") or m.get("text", ""))} for m in chat_history]
+        return recovery_prompt.build(history=history, context=context, user_query=sanitize_text(user_query or ""))
+
     is_recovery_query = any(k in combined_query.lower() for k in ["recovery","sleep","rest","fatigue","recover","tired"])
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.7, openai_api_key=OPENAI_API_KEY)
 
     if is_recovery_query:
         if not is_manual_flow:
             # --- Fitbit flow ---
             prompt_text = (
-                f"User Query: {combined_query}\n"
                 f"Fitbit Username: {username}\n"
                 f"Sleep Hours: {sleep_hours}\n"
                 f"Calories Burned: {calories_burned}\n"
@@ -193,19 +267,28 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
                     state["invocation_log"] = state.get("invocation_log", []) + ["Recovery->Trainer"]
                     state = await trainer_node(state, {"token": token, "caller": "recovery"})
                     trainer_invoked = True
-                except Exception as e:
-                    state["trainer_response"] = f"Unauthorized: {str(e)}"
+                except CassetteMiss:
+                    raise
+                except HTTPException as e:
+                    state["trainer_response"] = f"Unauthorized: {e.detail}"
+                except UpstreamUnavailable as e:
+                    logging.warning("[RecoveryAgent] Trainer unavailable: %s", e)
+                    state["trainer_response"] = AGENT_UNAVAILABLE_MESSAGE.format(agent="trainer")
             if nutrition_node and "nutrition_response" not in state:
                 try:
                     await verify_descope_token(token, RECOVERY_INVOKE_NUTRITION)
                     state["invocation_log"] = state.get("invocation_log", []) + ["Recovery->Nutrition"]
                     state = await nutrition_node(state, {"token": token, "caller": "recovery"})
                     nutrition_invoked = True
-                except Exception as e:
-                    state["nutrition_response"] = f"Unauthorized: {str(e)}"
+                except CassetteMiss:
+                    raise
+                except HTTPException as e:
+                    state["nutrition_response"] = f"Unauthorized: {e.detail}"
+                except UpstreamUnavailable as e:
+                    logging.warning("[RecoveryAgent] Nutrition unavailable: %s", e)
+                    state["nutrition_response"] = AGENT_UNAVAILABLE_MESSAGE.format(agent="nutrition")
 
             prompt_text = (
-                f"User Query: {combined_query}\n"
                 f"Sleep Hours: {sleep_hours}\n"
                 f"Calories Burned: {calories_burned}\n"
                 f"Protein Intake: {manual_protein}g\n"
@@ -217,14 +300,12 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
                 "Avoid emojis, symbols, or asterisks."
             )
 
-        messages = chat_prompt.format_prompt(user_query=prompt_text).to_messages()
-        response = await llm.ainvoke(messages)
+        response = await invoke_agent_llm("recovery", state, build_prompt(prompt_text), OPENAI_API_KEY)
         state["recovery_response"] = response.content
         return state
 
     # --- Fallback LLM response if not a recovery query ---
     prompt = (
-        f"User Query: {combined_query}\n"
         f"Sleep Hours: {sleep_hours}\n"
         f"Calories Burned: {calories_burned}\n"
         f"Trainer Advice: {state.get('trainer_response','N/A') if 'trainer_response' in state else 'N/A'}\n"
@@ -232,8 +313,7 @@ async def recovery_node(state: Dict, context: Dict, trainer_node=None, nutrition
         "Provide comprehensive recovery analysis including training and diet suggestions if available, "
         "without emojis or symbols."
     )
-    messages = chat_prompt.format_prompt(user_query=prompt).to_messages()
-    response = await llm.ainvoke(messages)
+    response = await invoke_agent_llm("recovery", state, build_prompt(prompt), OPENAI_API_KEY)
     state["recovery_response"] = response.content
 
     return state
@@ -2,10 +2,11 @@
 import os
 import logging
 from dotenv import load_dotenv
-from langchain_community.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+from fastapi import HTTPException
 from scopes import TRAINER_SUGGEST
 from auth import verify_descope_token
+from utils.model_router import invoke_agent_llm
+from utils.prompt_builder import register_prompt
 import re  # For sanitization
 
 load_dotenv()
@@ -16,7 +17,8 @@ MUSCLEWIKI_URL = "https://musclewiki.com"
 logging.basicConfig(level=logging.INFO)
 
 # Updated system prompt: instruct LLM to mention MuscleWiki URL (plain) in every response
-system_prompt = SystemMessagePromptTemplate.from_template(
+trainer_prompt = register_prompt(
+    "trainer",
     "You are a professional and approachable gym trainer. You can give a training plan too. "
     "Provide accurate, concise exercise and fitness guidance. "
     "Respond only with information directly related to physical training, workouts, exercises, sets, reps, recovery, and muscle targeting. "
@@ -28,9 +30,6 @@ system_prompt = SystemMessagePromptTemplate.from_template(
     "If the query includes nutrition or diet, only acknowledge it briefly and defer to the Nutrition Agent."
 )
 
-user_prompt_template = HumanMessagePromptTemplate.from_template("{user_query}")
-chat_prompt = ChatPromptTemplate.from_messages([system_prompt, user_prompt_template])
-
 # Utility to sanitize chat content
 def sanitize_text(text: str) -> str:
     # Remove only asterisks (*) and hashtags (#)
@@ -57,20 +56,15 @@ async def trainer_node(state: dict, context: dict) -> dict:
 
     try:
         await verify_descope_token(token, TRAINER_SUGGEST)
-    except Exception as e:
-        state["trainer_response"] = f"⛔ Unauthorized: {str(e)}"
+    except HTTPException as e:
+        # Only a scope/token denial is "Unauthorized"; a Descope outage propagates as UpstreamUnavailable
+        state["trainer_response"] = f"⛔ Unauthorized: {e.detail}"
         return state
 
-    # Combine sanitized chat history into user query
-    history_text = ""
-    if chat_history:
-        sanitized_history = [sanitize_text(msg.get("content", "")) for msg in chat_history]
-        history_text = "\n".join(f"User: {h}" for h in sanitized_history)
-        user_query = f"{history_text}\nUser: {sanitize_text(user_query)}"
-
-    llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.7, openai_api_key=OPENAI_API_KEY)
-    messages = chat_prompt.format_messages(user_query=user_query)
-    response = await llm.ainvoke(messages)
+    # History goes in as separate turns after the fixed system prompt, so the prompt prefix stays cacheable
+    history = [{"role": m.get("role", "user"), "content": sanitize_text(m.get("content", ""))} for m in chat_history]
+    prompt = trainer_prompt.build(history=history, user_query=sanitize_text(user_query))
+    response = await invoke_agent_llm("trainer", state, prompt, OPENAI_API_KEY)
 
     # Sanitize LLM output
     response_text = sanitize_text(response.content)
@@ -2,6 +2,7 @@
 import logging
 from fastapi import HTTPException
 from utils.descope_utils import verify_scope
+from utils.resilience import UpstreamUnavailable
 
 logging.basicConfig(level=logging.INFO)
 
@@ -22,18 +23,19 @@ async def verify_descope_token(token: str, required_scope: str, return_payload:
         logging.warning("[Auth] Missing token")
         raise HTTPException(status_code=401, detail="Missing token")
 
-    logging.info(f"[Auth] Token received: {token[:20]}...")  # Partial token for safety
-
     try:
         # Validate token and check for the required scope using Descope utils
         payload = await verify_scope(token, required_scope)
         if not payload:
-            logging.warning(f"[Auth] Missing required scope: {required_scope}")
+            logging.warning("[Auth] Missing required scope: %s", required_scope)
             raise HTTPException(status_code=403, detail=f"Missing required scope: {required_scope}")
 
-        logging.info(f"[Auth] Scope '{required_scope}' verified successfully")
+        logging.info("[Auth] Scope '%s' verified successfully", required_scope)
         return payload if return_payload else True
 
+    except UpstreamUnavailable:
+        # Descope is down: let callers surface a 503 instead of "Unauthorized"
+        raise
     except Exception as e:
         logging.error(f"[Auth] Token verification failed: {e}")
         raise HTTPException(status_code=401, detail="Invalid token")
@@ -0,0 +1,85 @@
+# backend/batch_cli.py
+"""
+Run a JSONL file of saved /agent_query bodies through the orchestrator.
+
+    python batch_cli.py --input queries.jsonl --output results.jsonl --token <jwt>
+
+Results are written as JSONL in input order. Progress is recorded in a checkpoint
+file after every result, so re-running the same command after a crash resumes
+where it stopped. Items that hit the token's quota wait for it to refill, so a
+large file runs at the quota's rate rather than recording failures.
+"""
+import os
+import json
+import asyncio
+import argparse
+import logging
+import orjson
+from main import run_agent_query_batch, parse_jsonl, claims_subject, BATCH_CONCURRENCY
+from utils.descope_utils import get_token_claims
+
+
+def read_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return int(json.load(f).get("next_index", 0))
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path: str, next_index: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"next_index": next_index}, f)
+    os.replace(tmp_path, path)
+
+
+def truncate_output(path: str, keep_lines: int):
+    # A crash between writing a result and updating the checkpoint leaves extra lines behind
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        lines = f.readlines()
+    if len(lines) != keep_lines:
+        with open(path, "wb") as f:
+            f.writelines(lines[:keep_lines])
+
+
+async def run(args):
+    if not claims_subject(await get_token_claims(args.token)):
+        raise SystemExit("Invalid token")
+    checkpoint = args.checkpoint or f"{args.output}.checkpoint"
+    start = read_checkpoint(checkpoint)
+    truncate_output(args.output, start)
+    if start:
+        logging.info("[Batch] Resuming from item %d", start)
+
+    with open(args.input, "rb") as f:
+        lines = f.readlines()
+
+    done = start
+    with open(args.output, "ab") as out:
+        async for result in run_agent_query_batch(parse_jsonl(lines, start), args.token, args.concurrency, fields=args.fields):
+            out.write(orjson.dumps(result) + b"\n")
+            out.flush()
+            done = result["index"] + 1
+            write_checkpoint(checkpoint, done)
+    logging.info("[Batch] Completed %d items", done)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL of queries through the fitness agents.")
+    parser.add_argument("--input", required=True, help="JSONL file, one /agent_query body per line")
+    parser.add_argument("--output", required=True, help="JSONL file results are appended to, in input order")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--token", default=os.getenv("AGENT_BATCH_TOKEN"), help="Descope JWT (default: $AGENT_BATCH_TOKEN)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Max queries in flight")
+    parser.add_argument("--fields", help="Response field mask, e.g. message,intent,agents,trainer_response")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("--token or AGENT_BATCH_TOKEN is required")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
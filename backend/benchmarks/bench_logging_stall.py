@@ -0,0 +1,85 @@
+# backend/benchmarks/bench_logging_stall.py
+"""
+Event-loop stall caused by logging on the hot path, synchronous vs queue-based.
+
+Simulates concurrent requests that each log like /agent_query does (several
+INFO records per hop, some with large payloads) to a sink whose writes block
+briefly, as a busy stderr pipe or log shipper does. A ticker task measures how
+late the event loop wakes it up.
+
+Run from backend/:  python -m benchmarks.bench_logging_stall
+"""
+import io
+import time
+import asyncio
+import logging
+import statistics
+from utils.logging_utils import setup_logging, shutdown_logging
+
+REQUESTS = 200
+LOGS_PER_REQUEST = 12
+WRITE_BLOCK_SECONDS = 0.0002
+PAYLOAD = {"access_token": "eyJhbGciOi.eyJzdWIiOi.sig", "sleep": [{"minutesAsleep": 420}] * 20}
+
+
+class SlowStream(io.StringIO):
+    def write(self, s):
+        time.sleep(WRITE_BLOCK_SECONDS)
+        return super().write(s)
+
+
+async def fake_request(i: int):
+    for j in range(LOGS_PER_REQUEST):
+        logging.info("[Orchestrator] request %d hop %d payload %s", i, j, PAYLOAD)
+        await asyncio.sleep(0)
+
+
+async def measure() -> dict:
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(fake_request(i) for i in range(REQUESTS)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+    return {
+        "wall_ms": elapsed * 1000,
+        "max_lag_ms": max(lags) * 1000,
+        "p50_lag_ms": statistics.median(lags) * 1000,
+    }
+
+
+def run(label: str):
+    result = asyncio.run(measure())
+    print(f"{label:<28} wall {result['wall_ms']:8.1f} ms | loop lag p50 {result['p50_lag_ms']:6.2f} ms, max {result['max_lag_ms']:7.2f} ms")
+
+
+def main():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    sync_handler = logging.StreamHandler(SlowStream())
+    root.addHandler(sync_handler)
+    root.setLevel(logging.INFO)
+    run("sync StreamHandler")
+    root.removeHandler(sync_handler)
+
+    setup_logging(level="INFO", fmt="json", sample_rates="", stream=SlowStream())
+    run("queue + JSON + redaction")
+    shutdown_logging()
+
+    setup_logging(level="INFO", fmt="json", sample_rates="Orchestrator=0.1", stream=SlowStream())
+    run("queue + sampling 10%")
+    shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# backend/benchmarks/bench_response_payload.py
+"""
+Payload size and serialize time of /agent_query responses against history length.
+
+Compares the old full-state echo (jsonable_encoder + stdlib json, as FastAPI does
+for a returned dict with its default JSONResponse) with the lean masked response,
+both as a returned dict (jsonable_encoder + orjson, what response_class=ORJSONResponse
+alone gives) and as the ORJSONResponse the endpoint now returns directly.
+
+Run from backend/:  python -m benchmarks.bench_response_payload
+"""
+import json
+import time
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from utils.response_utils import DEFAULT_FIELDS, RESPONSE_FIELDS, build_agent_response
+
+HISTORY_LENGTHS = [1, 15, 50, 200, 1000]
+REPEATS = 200
+
+AGENT_TEXT = "Do 3 sets of 10 reps of goblet squats, rest 90 seconds between sets. " * 20
+
+
+def make_state(history_len: int) -> dict:
+    state = {
+        "user_query": "Give me a workout and diet plan",
+        "chat_history": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": AGENT_TEXT}
+            for i in range(history_len)
+        ],
+        "fitbit_token": "x" * 400,
+        "fitbit_linked": True,
+        "manual_sleep_hours": 7,
+        "trainer_response": AGENT_TEXT,
+        "nutrition_response": AGENT_TEXT,
+        "recovery_response": AGENT_TEXT,
+        "invocation_log": ["Recovery->Trainer", "Recovery->Nutrition"],
+    }
+    for key in ["username", "sleep_hours", "calories_burned", "steps", "distance", "active_minutes"]:
+        state[f"fitbit_{key}"] = 1
+    return state
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn()
+    return (time.perf_counter() - start) / REPEATS * 1e6
+
+
+def main():
+    print(f"{'history':>8} | {'full bytes':>10} {'full us':>9} | {'lean bytes':>10} {'dict us':>8} {'direct us':>9} | "
+          f"{'all-fields bytes':>16} {'dict us':>8} {'direct us':>9}")
+    for n in HISTORY_LENGTHS:
+        state = make_state(n)
+        message = AGENT_TEXT * 3
+
+        def full():
+            return json.dumps(jsonable_encoder({"user_id": "anonymous", "message": message, "intent": "both", **state})).encode()
+
+        def payload(fields):
+            return build_agent_response("anonymous", message, "both", state, agents=["trainer", "nutrition"], fields=fields)
+
+        def as_dict(fields):
+            return lambda: ORJSONResponse(jsonable_encoder(payload(fields))).body
+
+        def direct(fields):
+            return lambda: ORJSONResponse(payload(fields)).body
+
+        print(f"{n:>8} | {len(full()):>10} {timed(full):>9.1f} | "
+              f"{len(direct(DEFAULT_FIELDS)()):>10} {timed(as_dict(DEFAULT_FIELDS)):>8.1f} {timed(direct(DEFAULT_FIELDS)):>9.1f} | "
+              f"{len(direct(RESPONSE_FIELDS)()):>16} {timed(as_dict(RESPONSE_FIELDS)):>8.1f} {timed(direct(RESPONSE_FIELDS)):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,24 +2,40 @@
 import os
 import logging
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from langchain_community.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field
 import re
 import httpx
 import asyncio, copy
+import json
+import time
+import orjson
+from collections import deque
+from functools import partial
 from agents.trainer_agent import trainer_node
 from agents.nutrition_agent import nutrition_node
 from agents.recovery_agent import recovery_node
 from scopes import TRAINER_SUGGEST, NUTRITION_DIETPLAN, RECOVERY_COLLECT
 from auth import verify_descope_token
+from utils.response_utils import AgentQueryResponse, build_agent_response, parse_fields
+from utils.descope_utils import get_token_claims, claims_expiry
+from utils.session_store import CONSENT_TTL_SECONDS, session_store
+from utils.resilience import AGENT_UNAVAILABLE_MESSAGE, UpstreamUnavailable, call_llm, call_with_resilience
+from utils.llm_cassette import CassetteMiss
+from utils import metrics
+from utils.model_router import get_chat_model
+from utils.logging_utils import setup_logging
+from utils.profiling import ProfilingMiddleware, profile_span
+from utils.idempotency import IdempotencyConflict, idempotency, request_fingerprint, scoped_key
+from utils.prompt_builder import register_prompt, record_usage, begin_usage, trim_history
+from utils import quota
+from utils.quota import QuotaExceeded
 
 # Load environment variables
 load_dotenv()
-user_states = {}
+user_states = session_store.user_states
 
 # Initialize FastAPI
 app = FastAPI(title="Fitness Backend")
@@ -34,28 +50,35 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Per-request profiling, triggered by the X-Profile admin header or PROFILE_SAMPLE_RATE
+app.add_middleware(ProfilingMiddleware)
 
-# Logging
-logging.basicConfig(level=logging.INFO)
+# Logging: non-blocking, structured and redacted (see utils/logging_utils.py)
+setup_logging()
 
 # LLM for intent classification
-orchestrator_llm = ChatOpenAI(
-    model_name="gpt-4o-mini",
-    temperature=0,
-    openai_api_key=os.environ.get("OPENAI_API_KEY"),
-)
-
-# Intent classifier prompt (base)
-intent_prompt = ChatPromptTemplate.from_template(
-    """You are an intent classifier. User says:
-"{user_input}"
-Decide if the query is about:
+ORCHESTRATOR_MODEL = "gpt-4o-mini"
+orchestrator_llm = get_chat_model(ORCHESTRATOR_MODEL, None, 0, os.environ.get("OPENAI_API_KEY"))
+
+# Intent classifier: fixed instructions first, then the conversation, then the current input
+intent_prompt = register_prompt(
+    "intent",
+    """You are an intent classifier. Consider the conversation so far and the current user input.
+Decide if the current input is about:
 - "trainer"
 - "nutrition"
 - "recovery"
 - "both"
 - "casual"
-Return only one word."""
+Return only one word.""",
+    "Current user input:\n{user_query}",
+)
+
+casual_prompt = register_prompt(
+    "casual",
+    """Respond casually but only about workouts, nutrition, or recovery.
+If unrelated, give a polite fallback Greet user if they greet you (Hi, bye, take care, etc. ).
+No emoji's, special symbols, or asterisks in your response.""",
 )
 
 # Map intents to agent flows
@@ -67,48 +90,48 @@ INTENT_TO_FLOW = {
     "casual": [],
 }
 
+# Agents that require user consent before they read the query/data
+CONSENT_AGENTS = ["trainer", "nutrition", "recovery"]
 
-async def classify_intent(user_input: str, history_text: str | None = None, last_agent_context: str | None = None) -> str:
+
+def parse_intent(content: str) -> str:
+    result = content.strip().lower()
+    return result.split()[0] if result else "casual"
+
+
+async def classify_intent(user_input: str, history: list[dict] | None = None, last_agent_context: str | None = None) -> str:
     """
-    Classify intent. If history_text is provided, include it in the prompt for context-aware classification.
+    Classify intent. If history is provided, it is included in the prompt for context-aware classification.
     Returns one of: trainer, nutrition, recovery, both, casual (defaults to casual on error).
+    Raises UpstreamUnavailable if OpenAI is failing, rather than silently treating the query as casual,
+    and CassetteMiss when a strict cassette replay has no recording.
     """
     try:
         logging.info("[Intent] Classifying intent for user input: %s", user_input)
-        if history_text:
-            prompt_template = ChatPromptTemplate.from_template(
-                f"""You are an intent classifier. Consider the following conversation history and current input:
-{history_text}
-
-Current user input:
-{user_input}
+        prompt = intent_prompt.build(history=history, user_query=user_input)
+        result = await call_llm(orchestrator_llm, prompt.messages, name="intent")
+        await record_usage("intent", result, prompt, model=ORCHESTRATOR_MODEL)
 
-Decide if the query is about:
-- "trainer"
-- "nutrition"
-- "recovery"
-- "both"
-- "casual"
-Return only one word."""
-            )
-            chain = prompt_template | orchestrator_llm
-            result = (await chain.ainvoke({})).content.strip().lower()
-        else:
-            chain = intent_prompt | orchestrator_llm
-            result = (await chain.ainvoke({"user_input": user_input})).content.strip().lower()
-
-        intent_result = result.split()[0] if result else "casual"
+        intent_result = parse_intent(result.content)
         logging.info("[Intent] Classified intent: %s", intent_result)
         return intent_result
+    except (UpstreamUnavailable, CassetteMiss):
+        raise
     except Exception as e:
         logging.error("[Intent] Error classifying intent: %s", e)
         return "casual"
 
 
+class ConsentRequest(BaseModel):
+    agents: list[str] = CONSENT_AGENTS
+    ttl_seconds: int | None = Field(None, ge=1, le=CONSENT_TTL_SECONDS)
+
+
 class AgentQuery(BaseModel):
     user_id: str = "anonymous"
     context: str
     consent_granted: bool = False  # Added for inter-agent consent
+    fields: str | list[str] | None = None  # Opt-in response field mask, e.g. "message,intent,agents"
 
 
 # Root and health endpoints
@@ -118,6 +141,27 @@ def root():
     return {"status": "ok", "message": "Welcome to Fitness Backend"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return metrics.render_prometheus()
+
+
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable_handler(request: Request, exc: UpstreamUnavailable):
+    logging.warning("[Resilience] %s", exc)
+    return JSONResponse(status_code=503, content={"status": "error", "message": str(exc)})
+
+
+def quota_exceeded_response(exc: QuotaExceeded, content: dict) -> JSONResponse:
+    headers = {"Retry-After": str(int(exc.retry_after))} if exc.retry_after is not None else None
+    return JSONResponse(status_code=429, content=content, headers=headers)
+
+
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_handler(request: Request, exc: QuotaExceeded):
+    return quota_exceeded_response(exc, {"status": "error", "message": str(exc)})
+
+
 @app.get("/health")
 def health_check():
     logging.info("[Health] Health check endpoint hit")
@@ -129,37 +173,66 @@ def sanitize_text(text: str) -> str:
     return re.sub(r"[*#]", "", text)
 
 
-# Main agent query endpoint
-@app.post("/agent_query")
-async def agent_query(request: Request):
-    logging.info("[Orchestrator] /agent_query called")
-
+def get_bearer_token(request: Request) -> str:
     auth_header = request.headers.get("Authorization")
     if not auth_header:
         logging.warning("[Auth] Missing Authorization header")
         raise HTTPException(status_code=401, detail="Missing token")
-    token = auth_header.split(" ", 1)[1]
+    return auth_header.split(" ", 1)[-1]
 
-    body_data = {}
-    try:
-        body_data = await request.json()
-    except Exception:
-        raw = await request.body()
-        try:
-            body_text = raw.decode("utf-8")
-            body_data = {"context": body_text}
-        except Exception:
-            body_data = {}
 
-    try:
-        query = AgentQuery(**body_data)
-    except Exception:
-        context_val = body_data.get("context") or ""
-        query = AgentQuery(context=context_val)
+def claims_subject(claims: dict | None) -> str | None:
+    # Consent grants are keyed on the verified Descope user, never on the client-sent user_id
+    if not claims:
+        return None
+    return claims.get("sub") or claims.get("userId")
+
+
+async def get_consent_user(request: Request) -> str:
+    token = get_bearer_token(request)
+    user = claims_subject(await get_token_claims(token))
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user
+
+
+# Consent endpoints: grant ahead of time so agent-bound queries run without the consent round trip
+@app.get("/consent")
+async def get_consent(request: Request):
+    user = await get_consent_user(request)
+    return {"status": "ok", "grants": await session_store.list_consents(user)}
+
+
+@app.post("/consent")
+async def grant_consent(request: Request, req: ConsentRequest):
+    user = await get_consent_user(request)
+    agents = [a for a in req.agents if a in CONSENT_AGENTS]
+    if not agents:
+        raise HTTPException(status_code=400, detail=f"agents must be any of {CONSENT_AGENTS}")
+    expires_at = await session_store.grant_consent(user, agents, req.ttl_seconds)
+    return {"status": "ok", "agents": agents, "expires_at": expires_at}
+
+
+@app.post("/consent/revoke")
+async def revoke_consent(request: Request, req: ConsentRequest | None = None):
+    user = await get_consent_user(request)
+    await session_store.revoke_consent(user, req.agents if req else None)
+    return {"status": "ok", "grants": await session_store.list_consents(user)}
+
+
+# Token usage, estimated cost and remaining quota for the caller and their tenant
+@app.get("/usage")
+async def get_usage(request: Request, days: int = 7):
+    claims = await get_token_claims(get_bearer_token(request))
+    user = claims_subject(claims)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return {"status": "ok", **await quota.usage_summary(user, quota.tenant_of(claims), min(max(days, 1), 31))}
 
-    logging.info("[Query] User query: %s", query.context)
 
-    state = {"user_query": query.context, "chat_history": []}
+def build_query_state(query: AgentQuery, body_data: dict, chat_history: list | None = None) -> dict:
+    """Build the initial agent state from a query and its Fitbit/manual data."""
+    state = {"user_query": query.context, "chat_history": list(chat_history or [])}
 
     fitbit_token = body_data.get("fitbit_token") or None
     if fitbit_token:
@@ -178,9 +251,45 @@ async def agent_query(request: Request):
             state["manual_protein_grams"] = protein_val
             logging.info("[Orchestrator] Manual protein provided: %s", protein_val)
 
+    return state
+
+
+async def run_agent_query(query: AgentQuery, token: str, state: dict, fields=None, emit=None,
+                          wait_for_quota: bool = False) -> dict:
+    """
+    Classify the query, check consent, run the agents and merge their responses.
+    Shared by /agent_query, the WebSocket chat and batch runs. If `emit` is given, it
+    is awaited with incremental events (intent, each agent response) as they become
+    available.
+
+    The token is verified before any LLM call, since quotas are charged to the verified
+    user: an invalid token raises HTTPException(401), and a Descope outage raises
+    UpstreamUnavailable (503) for every query, casual ones included. A short quota
+    raises QuotaExceeded, or with `wait_for_quota` (batch runs) is waited out.
+    """
+    fields = fields or parse_fields(None)
+    usage = begin_usage()
+    quota.begin_request()
+    claims = await get_token_claims(token)
+    if not claims_subject(claims):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    # Admits the request and its intent call; the fan-out is reserved once the intent is known
+    admit = partial(quota.admit, claims_subject(claims), quota.tenant_of(claims))
+    await (quota.wait_for(admit) if wait_for_quota else admit())
+    try:
+        return await answer_query(query, token, state, fields, emit, claims, usage, wait_for_quota)
+    finally:
+        # Shielded, so a cancelled request still hands back the budget it did not use
+        await asyncio.shield(quota.finish_request())
+
+
+async def answer_query(query: AgentQuery, token: str, state: dict, fields: tuple[str, ...], emit, claims: dict, usage: list,
+                       wait_for_quota: bool) -> dict:
+    """The part of run_agent_query after the request is admitted."""
     state.setdefault("chat_history", []).append({"role": "user", "content": query.context})
-    state["chat_history"] = state["chat_history"][-15:]
-    history_text = "\n".join([f"{m['role']}: {sanitize_text(m['content'])}" for m in state["chat_history"]])
+    # Trimmed in whole blocks rather than as a sliding window, so prompt prefixes stay cacheable
+    state["chat_history"] = trim_history(state["chat_history"])
+    history = [{"role": m["role"], "content": sanitize_text(m["content"])} for m in state["chat_history"]]
 
     followup_keywords = ["this", "that", "it", "more", "why", "again", "details", "how", "explain", "clarify"]
     is_followup = any(word in query.context.lower() for word in followup_keywords)
@@ -192,89 +301,104 @@ async def agent_query(request: Request):
         if last_responses:
             last_agent_context = "\nPrevious relevant responses:\n" + "\n".join(last_responses)
 
-    try:
-        logging.info("[Intent] Classifying intent with conversation history")
-        intent_input = f"Conversation so far:\n{history_text}\n\nCurrent user input:\n{sanitize_text(query.context)}"
-        if last_agent_context:
-            intent_input += f"{last_agent_context}"
-        intent = await classify_intent(sanitize_text(query.context), history_text=history_text, last_agent_context=last_agent_context)
-        intent = intent if intent in INTENT_TO_FLOW else "casual"
-        logging.info("[Intent] Classified intent: %s", intent)
-
-        flow = INTENT_TO_FLOW.get(intent, ["trainer"])
-        logging.info("[Orchestrator] Flow determined: %s", flow)
-
-        consent_needed_agents = []
-        if not query.consent_granted and any(a in flow for a in ["trainer", "nutrition", "recovery"]):
-            consent_needed_agents = flow
-            fitbit_needed = "recovery" in flow and not state.get("fitbit_token")
-            consent_message = f"Agent: {', '.join(consent_needed_agents)} need your consent to read your query/data. This is necessary to invoke the respective agents and give an accurate response. Don't worry, your information is protected. Do you want to Proceed?"
-            if fitbit_needed:
-                consent_message += " Fitbit authentication is required for recovery data."
-            logging.info("[Consent] Consent required for agents: %s", consent_needed_agents)
-            return {
-                "user_id": query.user_id,
-                "intent": "consent",
-                "consent_required": True,
-                "message": consent_message,
-                "agents": consent_needed_agents,
-            }
-
-        
-        tasks = []
-        if "trainer" in flow:
-            try:
-                await verify_descope_token(token, TRAINER_SUGGEST)
-                logging.info("[Orchestrator] Invoking TrainerAgent")
-                tasks.append(trainer_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"}))
-            except HTTPException:
-                state["trainer_response"] = "Unauthorized: Missing trainer scope"
-                logging.warning("[TrainerAgent] Unauthorized access attempt")
-        if "nutrition" in flow:
-            try:
-                await verify_descope_token(token, NUTRITION_DIETPLAN)
-                logging.info("[Orchestrator] Invoking NutritionAgent")
-                tasks.append(nutrition_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"}))
-            except HTTPException:
-                state["nutrition_response"] = "Unauthorized: Missing nutrition scope"
-                logging.warning("[NutritionAgent] Unauthorized access attempt")
-        if "recovery" in flow:
-            try:
-                await verify_descope_token(token, RECOVERY_COLLECT)
-                logging.info("[Orchestrator] Invoking RecoveryAgent")
-                tasks.append(recovery_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"},
-                                           trainer_node=trainer_node, nutrition_node=nutrition_node))
-            except HTTPException:
-                state["recovery_response"] = "Unauthorized: Missing recovery scope"
-                logging.warning("[RecoveryAgent] Unauthorized access attempt")
-
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for res in results:
-                if isinstance(res, Exception):
-                    logging.error("[Agent] Error during execution: %s", res)
-                    continue
-                if res:
-                    state.update(res)
-
-        if intent == "casual":
-            logging.info("[Orchestrator] Handling casual intent")
-            casual_prompt_text = f"""
-Conversation history:
-{history_text}
-User said: {sanitize_text(query.context)}.
-Respond casually but only about workouts, nutrition, or recovery. 
-If unrelated, give a polite fallback Greet user if they greet you (Hi, bye, take care, etc. ).
-No emoji's, special symbols, or asterisks in your response.
-"""
-            casual_prompt_text = casual_prompt_text.replace("{", "{{").replace("}", "}}")
-            casual_chain = ChatPromptTemplate.from_template(casual_prompt_text) | orchestrator_llm
-            message = (await casual_chain.ainvoke({})).content
-            message = sanitize_text(message)
-            state.setdefault("chat_history", []).append({"role": "assistant", "content": message})
-            logging.info("[Casual] Response generated")
-            return {"user_id": query.user_id, "message": message, "intent": intent, **state}
-
+    logging.info("[Intent] Classifying intent with conversation history")
+    intent = await classify_intent(sanitize_text(query.context), history=history, last_agent_context=last_agent_context)
+    intent = intent if intent in INTENT_TO_FLOW else "casual"
+    logging.info("[Intent] Classified intent: %s", intent)
+
+    flow = INTENT_TO_FLOW.get(intent, ["trainer"])
+    logging.info("[Orchestrator] Flow determined: %s", flow)
+    # Agents use the intent as a routing feature when picking a model tier
+    state["intent"] = intent
+
+    consent_agents = [a for a in flow if a in CONSENT_AGENTS]
+    consent_user = claims_subject(claims) if consent_agents else None
+    if consent_user and await session_store.has_consent(consent_user, consent_agents):
+        logging.info("[Consent] Consent on file for agents: %s", consent_agents)
+    elif query.consent_granted and consent_user:
+        await session_store.grant_consent(consent_user, consent_agents)
+    elif not query.consent_granted and consent_agents:
+        consent_needed_agents = flow
+        fitbit_needed = "recovery" in flow and not state.get("fitbit_token")
+        consent_message = f"Agent: {', '.join(consent_needed_agents)} need your consent to read your query/data. This is necessary to invoke the respective agents and give an accurate response. Don't worry, your information is protected. Do you want to Proceed?"
+        if fitbit_needed:
+            consent_message += " Fitbit authentication is required for recovery data."
+        logging.info("[Consent] Consent required for agents: %s", consent_needed_agents)
+        state["llm_usage"] = usage
+        return build_agent_response(query.user_id, consent_message, "consent", state,
+                                    agents=consent_needed_agents, fields=fields, consent_required=True)
+
+    # Taken before any agent fans out; what the agents do not use is refunded when the request finishes
+    reserve = partial(quota.reserve, quota.planned_calls(flow, intent))
+    await (quota.wait_for(reserve) if wait_for_quota else reserve())
+
+    if emit:
+        await emit({"type": "intent", "intent": intent, "agents": flow})
+
+    async def run_agent(name, agent_call):
+        try:
+            with profile_span("agent", name):
+                res = await agent_call
+        except UpstreamUnavailable as e:
+            # Say so explicitly instead of silently dropping the agent from the merged message
+            logging.warning("[Agent] %s unavailable: %s", name, e)
+            res = {f"{name}_response": AGENT_UNAVAILABLE_MESSAGE.format(agent=name)}
+        if emit and res and res.get(f"{name}_response"):
+            await emit({"type": "agent", "agent": name, "content": sanitize_text(res[f"{name}_response"])})
+        return res
+
+    tasks = []
+    if "trainer" in flow:
+        try:
+            await verify_descope_token(token, TRAINER_SUGGEST)
+            logging.info("[Orchestrator] Invoking TrainerAgent")
+            tasks.append(run_agent("trainer", trainer_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"})))
+        except HTTPException:
+            state["trainer_response"] = "Unauthorized: Missing trainer scope"
+            logging.warning("[TrainerAgent] Unauthorized access attempt")
+    if "nutrition" in flow:
+        try:
+            await verify_descope_token(token, NUTRITION_DIETPLAN)
+            logging.info("[Orchestrator] Invoking NutritionAgent")
+            tasks.append(run_agent("nutrition", nutrition_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"})))
+        except HTTPException:
+            state["nutrition_response"] = "Unauthorized: Missing nutrition scope"
+            logging.warning("[NutritionAgent] Unauthorized access attempt")
+    if "recovery" in flow:
+        try:
+            await verify_descope_token(token, RECOVERY_COLLECT)
+            logging.info("[Orchestrator] Invoking RecoveryAgent")
+            tasks.append(run_agent("recovery", recovery_node(copy.deepcopy(state), {"token": token, "caller": "orchestrator"},
+                                                             trainer_node=trainer_node, nutrition_node=nutrition_node)))
+        except HTTPException:
+            state["recovery_response"] = "Unauthorized: Missing recovery scope"
+            logging.warning("[RecoveryAgent] Unauthorized access attempt")
+
+    if tasks:
+        # gather keeps flow order for the state merge even though events are emitted as agents finish
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for res in results:
+            if isinstance(res, CassetteMiss):
+                # Strict replays must fail the run, not drop the agent from the merged message
+                raise res
+            if isinstance(res, Exception):
+                logging.error("[Agent] Error during execution: %s", res)
+                continue
+            if res:
+                state.update(res)
+
+    if intent == "casual":
+        logging.info("[Orchestrator] Handling casual intent")
+        prompt = casual_prompt.build(history=history, user_query=sanitize_text(query.context))
+        result = await call_llm(orchestrator_llm, prompt.messages, name="casual")
+        await record_usage("casual", result, prompt, model=ORCHESTRATOR_MODEL)
+        message = sanitize_text(result.content)
+        state.setdefault("chat_history", []).append({"role": "assistant", "content": message})
+        logging.info("[Casual] Response generated")
+        state["llm_usage"] = usage
+        return build_agent_response(query.user_id, message, intent, state, agents=flow, fields=fields)
+
+    with profile_span("merge", "responses"):
         response_parts = []
         seen_texts = set()
         for key in ["trainer_response", "nutrition_response", "recovery_response"]:
@@ -300,14 +424,347 @@ No emoji's, special symbols, or asterisks in your response.
                 response_parts.append(f"{header}\n{sanitized_response}")
                 state.setdefault("chat_history", []).append({"role": "assistant", "content": sanitized_response})
 
-        message = "\n\n".join(response_parts) if response_parts else "Couldn't understand query."
-        state["invocation_log"] = state.get("invocation_log", [])
-        logging.info("[Orchestrator] Returning combined message with history")
-        return {"user_id": query.user_id, "message": message, "intent": intent, **state}
+    message = "\n\n".join(response_parts) if response_parts else "Couldn't understand query."
+    state["invocation_log"] = state.get("invocation_log", [])
+    logging.info("[Orchestrator] Returning combined message with history")
+    state["llm_usage"] = usage
+    return build_agent_response(query.user_id, message, intent, state, agents=flow, fields=fields)
 
+
+async def parse_agent_query(request: Request) -> tuple[AgentQuery, dict]:
+    body_data = {}
+    try:
+        body_data = await request.json()
+    except Exception:
+        raw = await request.body()
+        try:
+            body_text = raw.decode("utf-8")
+            body_data = {"context": body_text}
+        except Exception:
+            body_data = {}
+
+    return make_agent_query(body_data), body_data
+
+
+def make_agent_query(body_data: dict) -> AgentQuery:
+    try:
+        return AgentQuery(**body_data)
+    except Exception:
+        context_val = body_data.get("context") or ""
+        return AgentQuery(context=str(context_val))
+
+
+def is_final_response(response: dict) -> bool:
+    """Whether a response may be replayed for a repeated Idempotency-Key (errors are retried instead)."""
+    return response.get("intent") != "error"
+
+
+# Main agent query endpoint
+@app.post("/agent_query", response_class=ORJSONResponse, responses={200: {"model": AgentQueryResponse}})
+async def agent_query(request: Request):
+    logging.info("[Orchestrator] /agent_query called")
+
+    token = get_bearer_token(request)
+    query, body_data = await parse_agent_query(request)
+    logging.info("[Query] User query: %s", query.context)
+
+    # Field mask: query string takes precedence over the body
+    fields = parse_fields(request.query_params.get("fields") or query.fields)
+    state = build_query_state(query, body_data)
+    idempotency_key = request.headers.get("Idempotency-Key")
+
+    try:
+        # Return the response directly: a returned dict would first go through FastAPI's jsonable_encoder
+        if not idempotency_key:
+            return ORJSONResponse(await run_agent_query(query, token, state, fields))
+        # Client retries of the same request attach to the original or get its stored result
+        result, replayed = await idempotency.run(
+            scoped_key(token, idempotency_key), request_fingerprint(body_data, fields),
+            lambda emit: run_agent_query(query, token, state, fields), store_result=is_final_response,
+        )
+        return ORJSONResponse(result, headers={"Idempotent-Replayed": "true"} if replayed else None)
+    except HTTPException:
+        raise
+    except IdempotencyConflict as e:
+        return JSONResponse(status_code=e.status_code, content={"user_id": query.user_id, "message": str(e), "intent": "error"})
+    except QuotaExceeded as e:
+        return quota_exceeded_response(e, {"user_id": query.user_id, "message": str(e), "intent": "error"})
+    except UpstreamUnavailable as e:
+        logging.warning("[Orchestrator] Upstream unavailable: %s", e)
+        return JSONResponse(status_code=503, content={"user_id": query.user_id, "message": f"{e.dependency} is temporarily unavailable, please retry shortly.", "intent": "error"})
     except Exception as e:
         logging.exception("[Orchestrator] Unexpected error in /agent_query")
-        return JSONResponse(status_code=500, content={"user_id": query.user_id if 'query' in locals() else "anonymous", "message": str(e), "intent": "error"})
+        return JSONResponse(status_code=500, content={"user_id": query.user_id, "message": str(e), "intent": "error"})
+
+
+# Batch runs: many saved queries through one bounded worker pool, results in input order
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+
+
+async def run_agent_query_batch(items, token: str, concurrency: int = BATCH_CONCURRENCY, fields=None):
+    """
+    Run (index, body) items through run_agent_query and yield one result per item,
+    in input order, each with per-item timing. At most `concurrency` items run at
+    once. A body that is an Exception (e.g. a JSONL parse error) yields an error result.
+    An item that hits the caller's quota waits for it to refill (keeping its admission and
+    classified intent), so a batch proceeds at the quota's rate instead of yielding (and
+    checkpointing) failures; only an item that needs more than a bucket holds fails.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, body, enqueued_at: float) -> dict:
+        async with semaphore:
+            started_at = time.perf_counter()
+            if isinstance(body, Exception):
+                response = {"message": f"Invalid query: {body}", "intent": "error"}
+            else:
+                query = make_agent_query(body)
+                state = build_query_state(query, body)
+                try:
+                    response = await run_agent_query(query, token, state, parse_fields(query.fields or fields), wait_for_quota=True)
+                except QuotaExceeded as e:
+                    response = {"user_id": query.user_id, "message": str(e), "intent": "error"}
+                except Exception as e:
+                    logging.exception("[Batch] Item %d failed", index)
+                    response = {"user_id": query.user_id, "message": str(e), "intent": "error"}
+            finished_at = time.perf_counter()
+        return {
+            "index": index,
+            "id": body.get("id") if isinstance(body, dict) else None,
+            "response": response,
+            "timing_ms": {
+                "queued": round((started_at - enqueued_at) * 1000, 1),
+                "run": round((finished_at - started_at) * 1000, 1),
+            },
+        }
+
+    # Keep a bounded window of scheduled items so huge inputs do not all become tasks at once
+    window = deque()
+    max_window = concurrency * 4
+    try:
+        for index, body in items:
+            window.append(asyncio.create_task(run_item(index, body, time.perf_counter())))
+            while window and (window[0].done() or len(window) >= max_window):
+                yield await window.popleft()
+        while window:
+            yield await window.popleft()
+    finally:
+        # The consumer stopped early (e.g. the client disconnected): stop the items still in flight
+        for task in window:
+            task.cancel()
+
+
+def parse_jsonl(lines, start: int = 0):
+    """Yield (index, body) for each non-empty JSONL line at or after `start`; bad lines yield the error."""
+    index = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        if index >= start:
+            try:
+                body = json.loads(line)
+                if not isinstance(body, dict):
+                    body = {"context": str(body)}
+            except ValueError as e:
+                body = e
+            yield index, body
+        index += 1
+
+
+@app.post("/agent_query/batch")
+async def agent_query_batch(request: Request, concurrency: int = BATCH_CONCURRENCY, start: int = 0, fields: str | None = None):
+    """
+    Body: JSONL, one /agent_query body per line. Response: JSONL streamed in input order.
+    `start` skips the first N queries so a client can resume from the results it already has.
+    """
+    logging.info("[Batch] /agent_query/batch called")
+    token = get_bearer_token(request)
+    # Checked up front: once the stream has started, every item would only fail on its own
+    if not claims_subject(await get_token_claims(token)):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    lines = (await request.body()).splitlines()
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+    async def stream():
+        async for result in run_agent_query_batch(parse_jsonl(lines, start), token, concurrency, fields=fields):
+            yield orjson.dumps(result) + b"\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# WebSocket chat: authenticate once per connection, then accept many turns
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "300"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "32"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+async def _ws_sender(websocket: WebSocket, outbox: asyncio.Queue):
+    # Single writer per connection; the bounded outbox is what applies backpressure to the turn
+    while True:
+        event = await outbox.get()
+        if event is None:
+            return
+        await websocket.send_json(event)
+
+
+async def _ws_receive_auth(websocket: WebSocket) -> dict:
+    """The first message of a connection without an Authorization header: {"type": "auth", "token", "fitbit_token"}."""
+    try:
+        data = json.loads(await asyncio.wait_for(websocket.receive_text(), WS_AUTH_TIMEOUT_SECONDS))
+    except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+        return {}
+    return data if isinstance(data, dict) and data.get("type") == "auth" else {}
+
+
+async def _ws_close(websocket: WebSocket, code: int, reason: str = ""):
+    try:
+        await websocket.close(code=code, reason=reason)
+    except RuntimeError:
+        pass
+
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    # Credentials never go in the URL, since servers log the full path and query string.
+    # Clients that can set headers send Authorization; browsers cannot, so they send an
+    # auth message first instead.
+    auth_header = websocket.headers.get("Authorization")
+    if auth_header:
+        auth = {"token": auth_header.split(" ", 1)[-1]}
+    else:
+        await websocket.accept()
+        auth = await _ws_receive_auth(websocket)
+    token = auth.get("token")
+    try:
+        claims = await get_token_claims(token) if token else None
+    except UpstreamUnavailable as e:
+        logging.warning("[WebSocket] Rejected connection: %s", e)
+        await _ws_close(websocket, status.WS_1013_TRY_AGAIN_LATER)
+        return
+    if not claims:
+        logging.warning("[WebSocket] Rejected connection with missing or invalid token")
+        await _ws_close(websocket, status.WS_1008_POLICY_VIOLATION)
+        return
+
+    if auth_header:
+        await websocket.accept()
+    session = {
+        "user_id": claims_subject(claims) or "anonymous",
+        "chat_history": [],
+        "consent_granted": False,
+        "fitbit_token": auth.get("fitbit_token"),
+        "manual_data": {},
+    }
+    logging.info("[WebSocket] Connection opened for user %s", session["user_id"])
+
+    outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+    sender = asyncio.create_task(_ws_sender(websocket, outbox))
+
+    async def emit(event: dict):
+        try:
+            await asyncio.wait_for(outbox.put(event), WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise SlowConsumer()
+
+    close_code, close_reason = status.WS_1000_NORMAL_CLOSURE, ""
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(websocket.receive_text(), WS_IDLE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                logging.info("[WebSocket] Closing idle connection for user %s", session["user_id"])
+                close_reason = "idle timeout"
+                break
+
+            exp = claims_expiry(claims)
+            if exp and exp < time.time():
+                close_code, close_reason = status.WS_1008_POLICY_VIOLATION, "token expired"
+                break
+
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                data = {"context": raw}
+            if not isinstance(data, dict):
+                data = {"context": str(data)}
+
+            if data.get("type") == "ping":
+                await emit({"type": "pong"})
+                continue
+            if data.get("type") == "clear":
+                session["chat_history"] = []
+                await emit({"type": "cleared"})
+                continue
+
+            # Per-connection context: later turns reuse whatever earlier turns sent
+            if "fitbit_token" in data:
+                session["fitbit_token"] = data.get("fitbit_token") or None
+            if "manual_data" in data:
+                session["manual_data"] = data.get("manual_data") or {}
+            if "consent_granted" in data:
+                session["consent_granted"] = bool(data.get("consent_granted"))
+
+            context = data.get("context") or ""
+            if not context:
+                await emit({"type": "error", "message": "Missing context"})
+                continue
+
+            query = AgentQuery(user_id=session["user_id"], context=context,
+                               consent_granted=session["consent_granted"], fields=data.get("fields"))
+            state = build_query_state(query, session, session["chat_history"])
+            fields = parse_fields(query.fields)
+            idempotency_key = data.get("idempotency_key")
+            await emit({"type": "start"})
+            try:
+                if idempotency_key:
+                    # A resent turn (e.g. after a reconnect) replays the original's events instead of re-running it
+                    response, _ = await idempotency.run(
+                        scoped_key(token, idempotency_key), request_fingerprint(context, fields, query.consent_granted),
+                        lambda tee: run_agent_query(query, token, state, fields, emit=tee),
+                        emit=emit, store_result=is_final_response,
+                    )
+                else:
+                    response = await run_agent_query(query, token, state, fields, emit=emit)
+            except SlowConsumer:
+                raise
+            except (IdempotencyConflict, QuotaExceeded) as e:
+                response = {"user_id": query.user_id, "message": str(e), "intent": "error"}
+            except Exception as e:
+                logging.exception("[WebSocket] Unexpected error handling turn")
+                response = {"user_id": query.user_id, "message": str(e), "intent": "error"}
+            await emit({"type": "message", **response})
+
+            if response.get("intent") not in ("consent", "error"):
+                session["chat_history"] = trim_history(session["chat_history"] + [
+                    {"role": "user", "content": context},
+                    {"role": "assistant", "content": response.get("message", "")},
+                ])
+    except WebSocketDisconnect:
+        logging.info("[WebSocket] Client disconnected: %s", session["user_id"])
+        sender.cancel()
+        return
+    except SlowConsumer:
+        logging.warning("[WebSocket] Closing slow consumer: %s", session["user_id"])
+        close_code, close_reason = status.WS_1013_TRY_AGAIN_LATER, "slow consumer"
+        sender.cancel()
+
+    # Let the sender flush what is queued before closing, unless the client stopped reading
+    if not sender.done():
+        if outbox.full():
+            sender.cancel()
+        else:
+            outbox.put_nowait(None)
+        await asyncio.gather(sender, return_exceptions=True)
+    await _ws_close(websocket, close_code, close_reason)
+
 
 # Fitbit OAuth callback endpoint
 class FitbitCallbackRequest(BaseModel):
@@ -345,15 +802,25 @@ async def fitbit_callback(req: FitbitCallbackRequest):
             "redirect_uri": f"{os.environ.get('FRONTEND_URL')}/api/auth/verify/fitbit/callback",
         }
         auth = (client_id, client_secret)
-        async with httpx.AsyncClient() as client:
+        async def exchange():
             response = await client.post(token_url, headers=headers, data=data, auth=auth)
+            if response.status_code >= 500 or response.status_code == 429:
+                response.raise_for_status()
+            return response
+
+        async with httpx.AsyncClient() as client:
+            # Authorization codes are single-use, so the exchange goes through the breaker but is never retried
+            response = await call_with_resilience("fitbit", exchange, retries=0)
             if response.status_code != 200:
                 logging.error("[Fitbit] Token exchange failed: %s", response.text)
                 raise HTTPException(status_code=500, detail="Fitbit token exchange failed")
             tokens = response.json()
 
-        logging.info("[Fitbit] Tokens received successfully: %s", tokens)
+        logging.info("[Fitbit] Tokens received successfully (scope: %s, expires_in: %s)", tokens.get("scope"), tokens.get("expires_in"))
         return {"status": "ok", "tokens": tokens}
+    except UpstreamUnavailable as e:
+        logging.warning("[Fitbit] %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logging.exception("[Fitbit] Error handling callback")
         raise HTTPException(status_code=500, detail=str(e))
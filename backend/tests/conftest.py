@@ -0,0 +1,64 @@
+import os
+import sys
+
+# The backend is run from its own directory and imports its modules top-level (`from utils import ...`)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep tests off the on-disk stores shared by local workers
+os.environ.setdefault("SHARED_CACHE_PATH", "off")
+os.environ.setdefault("IDEMPOTENCY_STORE", "memory")
+os.environ.setdefault("QUOTA_STORE", "memory")
+os.environ.setdefault("DESCOPE_PROJECT_ID", "P2testprojectid0000000000000")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("OPENAI_API_KEY_TRAIN_NUTRI", "sk-test")
+
+import pytest
+from langchain_core.messages import AIMessage
+
+
+class FakeBackend:
+    """Stand-ins for Descope and OpenAI behind the app: tokens map to claims, LLM calls are recorded."""
+
+    def __init__(self, client):
+        self.client = client
+        self.intent = "trainer"
+        self.llm_calls: list[str] = []
+        self.llm_inputs: list[list] = []
+        self.claims = {"good": {"sub": "U1"}, "other": {"sub": "U2"}}
+
+    async def get_token_claims(self, token: str) -> dict | None:
+        claims = self.claims.get(token)
+        return {**claims, "scope": self.scopes, "exp": 9e9} if claims else None
+
+    async def call_llm(self, runnable, inputs, hedge=None, name="llm", tier=None):
+        self.llm_calls.append(name)
+        self.llm_inputs.append(inputs)
+        content = self.intent if name == "intent" else f"{name} answer"
+        return AIMessage(content=content, response_metadata={"token_usage": {"prompt_tokens": 10, "completion_tokens": 5}})
+
+    def post(self, path: str, token: str = "good", headers: dict | None = None, **kwargs):
+        return self.client.post(path, headers={"Authorization": f"Bearer {token}", **(headers or {})}, **kwargs)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """The FastAPI app with fresh consent, quota and idempotency stores and fake Descope/OpenAI."""
+    from fastapi.testclient import TestClient
+
+    import main
+    import scopes
+    from utils import descope_utils, idempotency, model_router, quota
+    from utils.session_store import CONSENT_TTL_SECONDS
+    from utils.shared_cache import TwoLevelCache
+
+    with TestClient(main.app) as client:
+        backend = FakeBackend(client)
+        backend.scopes = [getattr(scopes, name) for name in dir(scopes) if name.isupper()]
+        monkeypatch.setattr(main, "get_token_claims", backend.get_token_claims)
+        monkeypatch.setattr(descope_utils, "get_token_claims", backend.get_token_claims)
+        monkeypatch.setattr(main, "call_llm", backend.call_llm)
+        monkeypatch.setattr(model_router, "call_llm", backend.call_llm)
+        monkeypatch.setattr(main.session_store, "_consents", TwoLevelCache("consent", None, default_ttl=CONSENT_TTL_SECONDS))
+        monkeypatch.setattr(quota, "store", quota.InMemoryQuotaStore())
+        monkeypatch.setattr(idempotency.idempotency, "store", idempotency.InMemoryIdempotencyStore())
+        yield backend
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import main
+from main import parse_jsonl, run_agent_query_batch
+
+
+def test_parse_jsonl_skips_blank_lines_and_resumes_from_start():
+    lines = [b'{"context": "a"}', b"", b"not json", b'"plain"', b'{"context": "d"}']
+    items = list(parse_jsonl(lines))
+    assert [index for index, _ in items] == [0, 1, 2, 3]
+    assert isinstance(items[1][1], ValueError)
+    assert items[2][1] == {"context": "plain"}
+    assert list(parse_jsonl(lines, start=2)) == items[2:]
+
+
+def test_results_come_back_in_input_order(monkeypatch):
+    async def slow_query(query, token, state, fields=None, emit=None, wait_for_quota=False):
+        # Later items finish first
+        await asyncio.sleep(0.01 * (5 - int(query.context)))
+        return {"message": query.context, "intent": "casual"}
+
+    monkeypatch.setattr(main, "run_agent_query", slow_query)
+    items = [(i, {"context": str(i), "id": f"q{i}"}) for i in range(5)]
+
+    async def collect():
+        return [result async for result in run_agent_query_batch(items, "good", concurrency=5)]
+
+    results = asyncio.run(collect())
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+    assert [r["id"] for r in results] == ["q0", "q1", "q2", "q3", "q4"]
+    assert [r["response"]["message"] for r in results] == ["0", "1", "2", "3", "4"]
+
+
+def test_batch_endpoint_resumes_from_start(api):
+    api.intent = "casual"
+    body = b"\n".join(json.dumps({"context": f"hi {i}", "id": i}).encode() for i in range(4))
+    response = api.post("/agent_query/batch?start=2", content=body)
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [(r["index"], r["id"]) for r in results] == [(2, 2), (3, 3)]
+    assert all(r["response"]["intent"] == "casual" for r in results)
+
+
+def test_batch_endpoint_rejects_a_bad_token_before_streaming(api):
+    assert api.post("/agent_query/batch", token="bad", content=b'{"context": "hi"}').status_code == 401
+    assert api.llm_calls == []
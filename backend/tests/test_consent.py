@@ -0,0 +1,35 @@
+def test_consent_grant_skips_the_prompt_until_revoked(api):
+    first = api.post("/agent_query", json={"context": "give me a workout"}).json()
+    assert first["intent"] == "consent" and first["consent_required"]
+
+    assert api.post("/consent", json={"agents": ["trainer"]}).status_code == 200
+    granted = api.post("/agent_query", json={"context": "give me a workout"}).json()
+    assert granted["intent"] == "trainer"
+    assert granted["message"].startswith("TRAINER RESPONSE:\ntrainer answer")
+
+    api.post("/consent/revoke", json={"agents": ["trainer"]})
+    revoked = api.post("/agent_query", json={"context": "give me a workout"}).json()
+    assert revoked["intent"] == "consent"
+
+
+def test_consent_on_file_is_not_rewritten_per_query(api, monkeypatch):
+    import main
+
+    api.post("/agent_query", json={"context": "give me a workout", "consent_granted": True})
+    writes = []
+    grant = main.session_store.grant_consent
+
+    async def counting_grant(*args, **kwargs):
+        writes.append(args)
+        return await grant(*args, **kwargs)
+
+    monkeypatch.setattr(main.session_store, "grant_consent", counting_grant)
+    for _ in range(3):
+        assert api.post("/agent_query", json={"context": "give me a workout", "consent_granted": True}).json()["intent"] == "trainer"
+    assert writes == []
+
+
+def test_consent_ttl_must_be_positive_and_bounded(api):
+    assert api.post("/consent", json={"ttl_seconds": 0}).status_code == 422
+    assert api.post("/consent", json={"ttl_seconds": 10**9}).status_code == 422
+    assert api.post("/consent", json={"ttl_seconds": 3600}).status_code == 200
@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+from utils import descope_utils
+
+
+def test_cached_claims_never_hold_the_raw_token(monkeypatch):
+    exp = time.time() + 300
+    session = {
+        "jwt": "raw.jwt.token", "sub": "U1", "scope": "trainer.suggest", "tenants": {"T1": {}},
+        "sessionToken": {"jwt": "raw.jwt.token", "exp": exp},
+    }
+    monkeypatch.setattr(descope_utils.descope_client, "validate_session", lambda token: session)
+    stored = {}
+
+    async def fake_set(key, value, ttl=None):
+        stored[key] = value
+    monkeypatch.setattr(descope_utils._claims_cache, "set", fake_set)
+
+    claims = asyncio.run(descope_utils.get_token_claims("raw.jwt.token"))
+
+    assert claims == {"sub": "U1", "scope": "trainer.suggest", "tenants": {"T1": {}}, "exp": exp}
+    assert "raw.jwt.token" not in repr(stored)
@@ -0,0 +1,82 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from utils.idempotency import IdempotencyConflict, IdempotencyManager, InMemoryIdempotencyStore
+
+
+async def _result(value):
+    return value
+
+
+def test_a_cancelled_original_hands_the_key_to_a_duplicate():
+    manager = IdempotencyManager(InMemoryIdempotencyStore())
+    runs = []
+
+    async def compute(emit):
+        runs.append(1)
+        await asyncio.sleep(0.05 if len(runs) == 1 else 0)
+        return {"run": len(runs)}
+
+    async def main_():
+        original = asyncio.create_task(manager.run("k", "f", compute))
+        await asyncio.sleep(0)
+        duplicate = asyncio.create_task(manager.run("k", "f", compute))
+        await asyncio.sleep(0.01)
+        original.cancel()
+        return await duplicate
+
+    assert asyncio.run(main_()) == ({"run": 2}, False)
+
+
+def test_an_error_result_is_not_replayed():
+    manager = IdempotencyManager(InMemoryIdempotencyStore())
+
+    async def main_():
+        first = await manager.run("k", "f", lambda emit: _result({"intent": "error"}), store_result=main.is_final_response)
+        second = await manager.run("k", "f", lambda emit: _result({"intent": "trainer"}), store_result=main.is_final_response)
+        with pytest.raises(IdempotencyConflict):
+            await manager.run("k", "other", lambda emit: _result({}))
+        return first, second
+
+    first, second = asyncio.run(main_())
+    assert first == ({"intent": "error"}, False)
+    assert second == ({"intent": "trainer"}, False)
+
+
+def test_concurrent_duplicates_attach_to_one_run(api, monkeypatch):
+    runs = []
+
+    async def slow_trainer(state, config):
+        runs.append(config["token"])
+        await asyncio.sleep(0.05)
+        return {"trainer_response": f"plan {len(runs)}"}
+
+    monkeypatch.setattr(main, "trainer_node", slow_trainer)
+    body = {"context": "give me a workout", "consent_granted": True}
+
+    async def post(client, token="good", key="k1", **overrides):
+        headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": key}
+        return await client.post("/agent_query", json={**body, **overrides}, headers=headers)
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            concurrent = await asyncio.gather(*(post(client) for _ in range(3)))
+            later = await post(client)
+            conflict = await post(client, context="another plan")
+            other_user = await post(client, token="other")
+        return concurrent, later, conflict, other_user
+
+    concurrent, later, conflict, other_user = asyncio.run(run())
+    assert [r.status_code for r in concurrent] == [200, 200, 200]
+    assert {r.json()["message"] for r in concurrent} == {"TRAINER RESPONSE:\nplan 1"}
+    assert sorted(r.headers.get("Idempotent-Replayed") or "" for r in concurrent) == ["", "true", "true"]
+    assert later.headers["Idempotent-Replayed"] == "true"
+    assert later.json()["message"] == "TRAINER RESPONSE:\nplan 1"
+    assert conflict.status_code == 422
+    # The same key from another caller is a separate request
+    assert other_user.status_code == 200 and "Idempotent-Replayed" not in other_user.headers
+    assert runs == ["good", "other"]
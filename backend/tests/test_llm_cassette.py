@@ -0,0 +1,29 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from utils import resilience
+from utils.llm_cassette import CassetteMiss, CassetteStore, CassetteTransport
+from utils.resilience import CLOSED, call_llm
+
+
+class _Completions:
+    """Minimal runnable: ainvoke() posts one chat completion through the given client."""
+
+    def __init__(self, client: openai.AsyncOpenAI):
+        self.client = client
+
+    async def ainvoke(self, messages):
+        return await self.client.chat.completions.create(model="gpt-4o-mini", messages=messages)
+
+
+def test_strict_miss_raises_cassette_miss_without_tripping_the_breaker(tmp_path, monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    transport = CassetteTransport(mode="strict", store=CassetteStore(str(tmp_path)))
+    client = openai.AsyncOpenAI(api_key="test", max_retries=2, http_client=httpx.AsyncClient(transport=transport))
+
+    with pytest.raises(CassetteMiss, match="No cassette recording"):
+        asyncio.run(call_llm(_Completions(client), [{"role": "user", "content": "hi"}]))
+    assert resilience.get_breaker("openai").state == CLOSED
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from utils import model_router
+from utils.model_router import Route, load_config, route, with_length_budget
+from utils.prompt_builder import CompiledPrompt
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    path = tmp_path / "routing.json"
+    path.write_text(json.dumps({
+        "default_tier": "standard",
+        "tiers": {
+            "light": {"model": "small-model", "max_tokens": 100, "temperature": 0.5},
+            "standard": {"model": "mid-model", "max_tokens": 500},
+            "plan": {"model": "big-model", "max_tokens": 2000},
+        },
+        "plan_keywords": ["plan", "weekly"],
+        "rules": [
+            {"tier": "plan", "when": {"plan_keywords": True}},
+            {"tier": "standard", "when": {"intents": ["recovery"]}},
+            {"tier": "standard", "when": {"personalized": True}},
+            {"tier": "light", "when": {"max_chars": 20}},
+        ],
+    }))
+    loaded = load_config.__wrapped__(str(path))
+    monkeypatch.setattr(model_router, "load_config", lambda: loaded)
+    return loaded
+
+
+@pytest.mark.parametrize("agent, state, tier", [
+    ("trainer", {"user_query": "Give me a weekly routine"}, "plan"),
+    ("recovery", {"user_query": "tired", "intent": "recovery"}, "standard"),
+    ("nutrition", {"user_query": "eggs?", "manual_protein_grams": 80}, "standard"),
+    ("nutrition", {"user_query": "eggs?"}, "light"),
+    ("trainer", {"user_query": "How should I warm up before a long run in cold weather?"}, "standard"),
+])
+def test_first_matching_rule_picks_the_tier(config, agent, state, tier):
+    selected = route(agent, state)
+    assert selected.tier == tier
+    assert selected.model == config.tiers[tier].model
+    assert selected.max_tokens == config.tiers[tier].max_tokens
+
+
+def test_unknown_tiers_are_rejected(tmp_path):
+    path = tmp_path / "routing.json"
+    path.write_text(json.dumps({"default_tier": "missing", "tiers": {"light": {"model": "m", "max_tokens": 1}}}))
+    with pytest.raises(ValueError, match="unknown tiers"):
+        load_config.__wrapped__(str(path))
+
+
+def test_length_budget_goes_after_the_cacheable_prefix():
+    built = CompiledPrompt("test", "You are a coach.").build(history=[{"role": "user", "content": "hi"}], user_query="plan?")
+    budgeted = with_length_budget(built, Route(tier="light", model="m", max_tokens=350, temperature=0.5))
+
+    assert budgeted.messages[:-2] == built.messages[:-1]
+    assert isinstance(budgeted.messages[-2], SystemMessage)
+    assert "210 words" in budgeted.messages[-2].content
+    assert isinstance(budgeted.messages[-1], HumanMessage) and budgeted.messages[-1].content == "plan?"
+    assert "length_budget" in budgeted.sections
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+
+from utils import profiling
+
+
+async def _app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def _request(request_id: str) -> list:
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": "/health", "headers": [(b"x-request-id", request_id.encode())]}
+    asyncio.run(profiling.ProfilingMiddleware(_app)(scope, None, send))
+    return sent
+
+
+def test_profile_files_never_use_the_client_request_id(tmp_path, monkeypatch):
+    profile_dir = tmp_path / "profiles"
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling.RequestProfile.write, "__defaults__", (str(profile_dir),))
+
+    sent = _request("../escaped")
+    profile_id = dict(sent[0]["headers"])[b"x-profile-id"].decode()
+
+    assert not (tmp_path / "escaped.speedscope.json").exists()
+    assert sorted(os.listdir(profile_dir)) == [f"{profile_id}.collapsed", f"{profile_id}.speedscope.json"]
+    assert json.loads((profile_dir / f"{profile_id}.speedscope.json").read_text())["request_id"] is None
+
+
+def test_valid_client_request_id_is_kept_as_metadata(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling.RequestProfile.write, "__defaults__", (str(tmp_path),))
+
+    sent = _request("req-1")
+    profile_id = dict(sent[0]["headers"])[b"x-profile-id"].decode()
+
+    assert profile_id != "req-1"
+    assert json.loads((tmp_path / f"{profile_id}.speedscope.json").read_text())["request_id"] == "req-1"
+
+
+def test_only_the_newest_profiles_are_kept(tmp_path):
+    for i, profile_id in enumerate(["old", "mid", "new"]):
+        for suffix in (".speedscope.json", ".collapsed"):
+            path = tmp_path / f"{profile_id}{suffix}"
+            path.write_text("{}")
+            os.utime(path, (i, i))
+    (tmp_path / "notes.txt").write_text("kept")
+
+    profiling.prune_profiles(str(tmp_path), keep=2)
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "mid.collapsed", "mid.speedscope.json", "new.collapsed", "new.speedscope.json", "notes.txt"]
+
+
+def test_admin_token_header_triggers_profiling(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_ADMIN_TOKEN", "s3cret")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0)
+    assert profiling._should_profile([(b"x-profile", b"s3cret")])
+    assert not profiling._should_profile([(b"x-profile", b"s3cre")])
+    assert not profiling._should_profile([])
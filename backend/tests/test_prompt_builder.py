@@ -0,0 +1,61 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from utils import prompt_builder
+from utils.prompt_builder import CompiledPrompt, trim_history
+
+
+def _turns(n: int) -> list[dict]:
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i}"} for i in range(n)]
+
+
+def test_messages_are_laid_out_most_stable_first():
+    prompt = CompiledPrompt("test", "You are a coach.")
+    built = prompt.build(history=_turns(2), context="Sleep Hours: 7", user_query="what now?")
+
+    assert [type(m) for m in built.messages] == [SystemMessage, HumanMessage, AIMessage, HumanMessage, HumanMessage]
+    assert built.messages[0].content == "You are a coach."
+    assert [m.content for m in built.messages[1:]] == ["turn 0", "turn 1", "Sleep Hours: 7", "what now?"]
+    assert list(built.sections) == ["system", "history", "context", "user"]
+
+
+def test_current_query_is_not_repeated_from_history():
+    prompt = CompiledPrompt("test", "system")
+    history = _turns(2) + [{"role": "user", "content": "what now?"}]
+    built = prompt.build(history=history, user_query="what now?")
+    assert [m.content for m in built.messages].count("what now?") == 1
+
+
+def test_user_text_with_braces_is_not_a_template():
+    prompt = CompiledPrompt("test", "system")
+    built = prompt.build(user_query="give me a {plan}")
+    assert built.messages[-1].content == "give me a {plan}"
+
+
+def test_history_is_trimmed_in_whole_blocks():
+    assert trim_history(_turns(15), max_turns=15, block=5) == _turns(15)
+    trimmed = trim_history(_turns(16), max_turns=15, block=5)
+    # One turn over the budget drops a whole block, so the first kept turn stays put for the next turns
+    assert trimmed == _turns(16)[5:]
+    assert trim_history(_turns(20), max_turns=15, block=5)[0] == trimmed[0]
+
+
+def test_older_turns_are_folded_into_a_summary(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "PROMPT_RECENT_TURNS", 6)
+    monkeypatch.setattr(prompt_builder, "PROMPT_HISTORY_BLOCK", 5)
+    built = CompiledPrompt("test", "system").build(history=_turns(12), user_query="next")
+
+    assert isinstance(built.messages[1], SystemMessage)
+    assert built.messages[1].content.startswith("Summary of the earlier conversation:")
+    assert "turn 4" in built.messages[1].content
+    assert [m.content for m in built.messages[2:-1]] == [f"turn {i}" for i in range(5, 12)]
+    assert "history_summary" in built.sections
+
+
+def test_token_counts_fall_back_to_an_estimate_without_a_cached_encoding(monkeypatch, tmp_path):
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    prompt_builder._get_encoding.cache_clear()
+    try:
+        assert prompt_builder._get_encoding() is None
+        assert prompt_builder.count_tokens("x" * 40) == 10
+    finally:
+        prompt_builder._get_encoding.cache_clear()
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from utils import quota
+from utils.quota import Bucket, InMemoryQuotaStore, QuotaConfig, QuotaExceeded
+
+
+@pytest.fixture
+def config(monkeypatch):
+    config = QuotaConfig(
+        user={"requests": Bucket(capacity=2, per_minute=0), "llm_calls": Bucket(capacity=4, per_minute=60),
+              "tokens": Bucket(capacity=1000, per_minute=0)},
+        tenant={"requests": Bucket(capacity=100, per_minute=0)},
+        estimated_tokens_per_call=100,
+        agent_calls={"trainer": 1, "nutrition": 1, "recovery": 3},
+    )
+    monkeypatch.setattr(quota, "load_config", lambda: config)
+    monkeypatch.setattr(quota, "store", InMemoryQuotaStore())
+    return config
+
+
+def _entry(tokens: int = 10) -> dict:
+    return {"prompt_tokens": tokens, "cached_tokens": 0, "completion_tokens": 0}
+
+
+async def _request(user: str, tenant: str | None, calls: int, tokens: int = 10):
+    """One request: admit, intent call, reserve the fan-out, make `calls` agent calls, finish."""
+    quota.begin_request()
+    await quota.admit(user, tenant)
+    try:
+        await quota.charge_call(_entry(tokens))
+        await quota.reserve(calls)
+        await asyncio.sleep(0)
+        for _ in range(calls):
+            await quota.charge_call(_entry(tokens))
+    finally:
+        await quota.finish_request()
+
+
+def test_admit_rejects_before_any_call_when_requests_are_used_up(config):
+    async def main():
+        for _ in range(2):
+            await _request("u", None, 0)
+        quota.begin_request()
+        with pytest.raises(QuotaExceeded) as e:
+            await quota.admit("u", None)
+        return e.value, await quota.usage_summary("u", None, days=1)
+
+    error, summary = asyncio.run(main())
+    assert error.dimension == "requests"
+    assert list(summary["user"]["usage"].values())[0] == {
+        "requests": 2, "llm_calls": 2, "prompt_tokens": 20, "cached_tokens": 0, "completion_tokens": 0, "cost_usd": 0}
+
+
+def test_concurrent_requests_cannot_overrun_the_call_budget(config):
+    async def one(user):
+        try:
+            await _request(user, None, 3)
+            return "ok"
+        except QuotaExceeded as e:
+            return e.dimension
+
+    async def main():
+        results = await asyncio.gather(*(one("u") for _ in range(2)))
+        return results, await quota.store.levels("user:u", config.user)
+
+    results, levels = asyncio.run(main())
+    # 1 intent + 3 agent calls fit the 4-call bucket once; the second request's fan-out is refused
+    assert sorted(results) == ["llm_calls", "ok"]
+    assert levels["llm_calls"] >= 0
+
+
+def test_unused_reservation_is_refunded(config):
+    async def main():
+        quota.begin_request()
+        await quota.admit("u", None)
+        await quota.reserve(2)
+        await quota.charge_call(_entry(50))
+        await quota.finish_request()
+        return await quota.store.levels("user:u", config.user)
+
+    levels = asyncio.run(main())
+    assert levels["tokens"] == 950
+    assert levels["llm_calls"] >= 3
+
+
+def test_a_need_above_capacity_cannot_be_waited_out(config):
+    async def main():
+        quota.begin_request()
+        await quota.admit("u", None)
+        with pytest.raises(QuotaExceeded) as e:
+            await quota.wait_for(lambda: quota.reserve(5))
+        return e.value
+
+    error = asyncio.run(main())
+    assert error.retry_after is None
+
+
+def test_users_without_a_tenant_are_not_pooled(config):
+    async def main():
+        await _request("a", None, 0)
+        await _request("b", "T1", 0)
+        return await quota.usage_summary("a", None, days=1), await quota.store.levels("tenant:T1", config.tenant)
+
+    summary, tenant_levels = asyncio.run(main())
+    assert summary["tenant"] is None
+    assert not any(scope.startswith("tenant:") and scope != "tenant:T1" for scope, _ in quota.store._buckets)
+    assert tenant_levels == {"requests": 99}
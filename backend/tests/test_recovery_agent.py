@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from agents import recovery_agent
+from utils import resilience
+from utils.resilience import UpstreamUnavailable
+
+
+@pytest.fixture
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY_SECONDS", 0)
+
+
+_AsyncClient = httpx.AsyncClient
+
+
+def _client(handler) -> httpx.AsyncClient:
+    return _AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_fitbit_429_is_not_retried_or_counted(fresh_breakers):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(429, headers={"Retry-After": "42"})
+
+    async def run():
+        async with _client(handler) as client:
+            with pytest.raises(recovery_agent.FitbitRateLimited) as e:
+                await recovery_agent.fitbit_get(client, "https://api.fitbit.com/1/user/-/profile.json", {})
+        return e.value
+
+    error = asyncio.run(run())
+    assert error.retry_after == 42
+    assert len(requests) == 1
+    assert resilience.get_breaker("fitbit").failures == 0
+
+
+def test_fitbit_rate_limit_stops_the_fetch_and_cools_the_token_down(fresh_breakers, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(429)
+
+    monkeypatch.setattr(recovery_agent.httpx, "AsyncClient", lambda: _client(handler))
+
+    async def run():
+        first = await recovery_agent.fetch_fitbit_data("limited-token")
+        second = await recovery_agent.fetch_fitbit_data("limited-token")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(requests) == 1
+    assert all(v is None for v in first.values()) and all(v is None for v in second.values())
+
+
+def _recovery_state() -> dict:
+    return {"user_query": "how should I recover after leg day", "chat_history": []}
+
+
+def test_nested_agent_outage_is_not_reported_as_unauthorized(monkeypatch):
+    async def allow(token, scope):
+        return True
+
+    async def trainer_down(state, context):
+        raise UpstreamUnavailable("openai", "openai is temporarily unavailable: Connection error.")
+
+    async def nutrition_ok(state, context):
+        return {**state, "nutrition_response": "Eat protein"}
+
+    async def fake_llm(agent, state, prompt, api_key):
+        return type("Response", (), {"content": "Rest well"})()
+
+    monkeypatch.setattr(recovery_agent, "verify_descope_token", allow)
+    monkeypatch.setattr(recovery_agent, "invoke_agent_llm", fake_llm)
+
+    state = asyncio.run(recovery_agent.recovery_node(_recovery_state(), {"token": "t"},
+                                                     trainer_node=trainer_down, nutrition_node=nutrition_ok))
+    assert state["trainer_response"] == "The trainer agent is temporarily unavailable, please try again shortly."
+    assert "Unauthorized" not in state["trainer_response"]
+    assert state["nutrition_response"] == "Eat protein"
+
+
+def test_nested_scope_denial_is_unauthorized(monkeypatch):
+    async def deny_trainer(token, scope):
+        if scope == recovery_agent.RECOVERY_INVOKE_TRAINER:
+            raise HTTPException(status_code=403, detail=f"Missing required scope: {scope}")
+        return True
+
+    async def fake_llm(agent, state, prompt, api_key):
+        return type("Response", (), {"content": "Rest well"})()
+
+    async def node(state, context):
+        return state
+
+    monkeypatch.setattr(recovery_agent, "verify_descope_token", deny_trainer)
+    monkeypatch.setattr(recovery_agent, "invoke_agent_llm", fake_llm)
+
+    state = asyncio.run(recovery_agent.recovery_node(_recovery_state(), {"token": "t"}, trainer_node=node, nutrition_node=node))
+    assert state["trainer_response"].startswith("Unauthorized: Missing required scope")
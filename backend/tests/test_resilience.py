@@ -0,0 +1,150 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+import requests
+from descope.exceptions import AuthException, RateLimitException, ERROR_TYPE_INVALID_TOKEN, ERROR_TYPE_SERVER_ERROR
+
+from utils import resilience
+from utils.resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, UpstreamUnavailable, call_with_resilience,
+    is_upstream_failure,
+)
+
+_REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    return httpx.HTTPStatusError("error", request=_REQUEST, response=httpx.Response(status, request=_REQUEST))
+
+
+def _openai_error(status: int) -> openai.APIStatusError:
+    return openai.APIStatusError("error", response=httpx.Response(status, request=_REQUEST), body=None)
+
+
+@pytest.mark.parametrize("error", [
+    asyncio.TimeoutError(),
+    httpx.ConnectError("refused"),
+    httpx.ReadTimeout("slow"),
+    _status_error(502),
+    _status_error(429),
+    openai.APIConnectionError(request=_REQUEST),
+    openai.APITimeoutError(request=_REQUEST),
+    _openai_error(500),
+    _openai_error(429),
+    requests.exceptions.ConnectionError(),
+    requests.exceptions.Timeout(),
+    RateLimitException(429),
+    AuthException(503, ERROR_TYPE_SERVER_ERROR, "unavailable"),
+])
+def test_transport_and_server_errors_are_failures(error):
+    assert is_upstream_failure(error)
+
+
+@pytest.mark.parametrize("error", [
+    AuthException(500, ERROR_TYPE_INVALID_TOKEN, "Unable to parse token header"),
+    AuthException(401, ERROR_TYPE_SERVER_ERROR, "unauthorized"),
+    _status_error(404),
+    _openai_error(400),
+    ValueError("bad input"),
+    KeyError("sub"),
+])
+def test_rejections_are_not_failures(error):
+    assert not is_upstream_failure(error)
+
+
+def test_breaker_opens_after_threshold_and_recovers(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=2, recovery_seconds=30)
+
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] += 30
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    # Only one trial call while half-open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+
+
+def test_failed_half_open_trial_reopens(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_seconds=30)
+    breaker.record_failure()
+    now[0] += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+@pytest.fixture
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(resilience, "_breakers", {})
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY_SECONDS", 0)
+
+
+def test_invalid_tokens_do_not_open_the_breaker(fresh_breakers):
+    calls = []
+
+    async def validate():
+        calls.append(1)
+        raise AuthException(500, ERROR_TYPE_INVALID_TOKEN, "Unable to parse token header")
+
+    async def run():
+        for _ in range(10):
+            with pytest.raises(AuthException):
+                await call_with_resilience("descope", validate)
+
+    asyncio.run(run())
+    assert len(calls) == 10  # never retried
+    assert resilience.get_breaker("descope").state == CLOSED
+
+
+def test_upstream_failures_are_retried_then_raise(fresh_breakers):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise httpx.ConnectError("refused")
+
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(call_with_resilience("fitbit", call, retries=2))
+    assert len(calls) == 3
+    assert resilience.get_breaker("fitbit").failures == 3
+
+
+def test_success_after_retry(fresh_breakers):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise _status_error(503)
+        return "ok"
+
+    assert asyncio.run(call_with_resilience("fitbit", call, retries=2)) == "ok"
+    assert resilience.get_breaker("fitbit").failures == 0
+
+
+def test_latencies_are_tracked_per_call_kind(fresh_breakers, monkeypatch):
+    monkeypatch.setattr(resilience, "_latencies", {})
+
+    async def call():
+        return "ok"
+
+    async def run():
+        await call_with_resilience("openai", call, latency_key="openai:intent")
+        await call_with_resilience("openai", call, latency_key="openai:trainer:plan")
+
+    asyncio.run(run())
+    assert set(resilience._latencies) == {"openai:intent", "openai:trainer:plan"}
@@ -0,0 +1,29 @@
+from utils.response_utils import DEFAULT_FIELDS, RESPONSE_FIELDS, build_agent_response, parse_fields
+
+_STATE = {"fitbit_token": "secret-token", "fitbit_linked": True, "fitbit_sleep_hours": 7, "manual_sleep_hours": 6}
+
+
+def test_parse_fields_ignores_unknown_names():
+    assert parse_fields(None) == DEFAULT_FIELDS
+    assert parse_fields("intent, fitbit_token") == ("intent",)
+    assert parse_fields(["fitbit_token"]) == DEFAULT_FIELDS
+    assert parse_fields("*") == RESPONSE_FIELDS
+
+
+def test_every_field_leaves_out_the_fitbit_token():
+    payload = build_agent_response("u", "hi", "recovery", _STATE, agents=["recovery"], fields=parse_fields("*"))
+    assert payload["fitbit_metrics"] == {"sleep_hours": 7}
+    assert payload["manual_data"] == {"manual_sleep_hours": 6}
+    assert "secret-token" not in repr(payload)
+
+
+def test_unrequested_and_unset_fields_are_omitted():
+    payload = build_agent_response("u", "hi", "trainer", {}, fields=("message", "usage"))
+    assert payload == {"message": "hi"}
+
+
+def test_agent_query_never_returns_the_fitbit_token(api):
+    api.post("/consent", json={})
+    response = api.post("/agent_query?fields=*", json={"context": "give me a workout", "fitbit_token": "secret-token"})
+    assert response.status_code == 200
+    assert "secret-token" not in response.text
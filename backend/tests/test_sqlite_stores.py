@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+from utils.idempotency import IN_FLIGHT, SQLiteIdempotencyStore
+from utils.quota import Bucket, SQLiteQuotaStore
+from utils.shared_cache import SharedTier, SQLiteDatabase, _MISSING
+
+
+def test_database_runs_statements_off_the_event_loop(tmp_path):
+    db = SQLiteDatabase(str(tmp_path / "t.db"), "CREATE TABLE t (x INTEGER);", "test")
+
+    async def main():
+        loop_thread = threading.get_ident()
+        thread = await db.write(lambda conn: (conn.execute("INSERT INTO t VALUES (1)"), threading.get_ident())[1])
+        rows = await db.read(lambda conn: conn.execute("SELECT x FROM t").fetchall())
+        return loop_thread, thread, rows
+
+    loop_thread, thread, rows = asyncio.run(main())
+    assert thread != loop_thread
+    assert rows == [(1,)]
+
+
+def test_failed_write_rolls_back(tmp_path):
+    db = SQLiteDatabase(str(tmp_path / "t.db"), "CREATE TABLE t (x INTEGER);", "test")
+
+    def insert_then_fail(conn):
+        conn.execute("INSERT INTO t VALUES (1)")
+        raise RuntimeError("boom")
+
+    async def main():
+        try:
+            await db.write(insert_then_fail)
+        except RuntimeError:
+            pass
+        return await db.read(lambda conn: conn.execute("SELECT COUNT(*) FROM t").fetchone()[0])
+
+    assert asyncio.run(main()) == 0
+
+
+def test_shared_tier_round_trip(tmp_path):
+    tier = SharedTier(str(tmp_path / "cache.db"))
+
+    async def main():
+        await tier.set("ns", "k", {"a": 1}, expires_at=10**10)
+        hit = await tier.get("ns", "k")
+        await tier.delete("ns", "k")
+        return hit, await tier.get("ns", "k")
+
+    hit, miss = asyncio.run(main())
+    assert hit == ({"a": 1}, 10**10)
+    assert miss[0] is _MISSING
+
+
+def test_quota_acquire_takes_nothing_when_short(tmp_path):
+    store = SQLiteQuotaStore(str(tmp_path / "quota.db"))
+    requests, calls = Bucket(capacity=5, per_minute=0), Bucket(capacity=2, per_minute=0)
+
+    async def main():
+        checks = [("user:u", "requests", 1, 1, requests), ("user:u", "llm_calls", 0, 3, calls)]
+        denied = await store.acquire(checks, ["user:u"], "2026-01-01", {"requests": 1})
+        levels = await store.levels("user:u", {"requests": requests, "llm_calls": calls})
+        usage = await store.usage("user:u", ["2026-01-01"])
+        return denied, levels, usage
+
+    denied, levels, usage = asyncio.run(main())
+    assert denied[:2] == ("user:u", "llm_calls")
+    assert levels == {"requests": 5, "llm_calls": 2}
+    assert usage == {}
+
+
+def test_quota_charge_records_usage_with_the_buckets(tmp_path):
+    store = SQLiteQuotaStore(str(tmp_path / "quota.db"))
+    tokens = Bucket(capacity=100, per_minute=0)
+
+    async def main():
+        await store.charge([("user:u", "tokens", 150, tokens)], ["user:u", "tenant:t"], "2026-01-01",
+                           {"llm_calls": 1, "prompt_tokens": 150})
+        return await store.levels("user:u", {"tokens": tokens}), await store.usage("tenant:t", ["2026-01-01"])
+
+    levels, usage = asyncio.run(main())
+    assert levels == {"tokens": -50}
+    assert usage["2026-01-01"]["llm_calls"] == 1
+    assert usage["2026-01-01"]["prompt_tokens"] == 150
+
+
+def test_idempotency_claim_is_exclusive_until_released(tmp_path):
+    store = SQLiteIdempotencyStore(str(tmp_path / "idem.db"))
+
+    async def main():
+        first = await store.claim("k", "f", 60)
+        second = await store.claim("k", "f", 60)
+        await store.release("k")
+        third = await store.claim("k", "f", 60)
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert first is None
+    assert second["status"] == IN_FLIGHT
+    assert third is None
@@ -0,0 +1,57 @@
+import pytest
+from fastapi import WebSocketDisconnect
+
+import main
+
+
+def _turn(ws, **message) -> tuple[list[str], dict]:
+    """Send one chat turn and collect its event types up to the final message."""
+    ws.send_json(message)
+    events = []
+    while True:
+        event = ws.receive_json()
+        events.append(event["type"])
+        if event["type"] == "message":
+            return events, event
+
+
+def test_header_auth_with_a_bad_token_is_rejected(api):
+    with pytest.raises(WebSocketDisconnect) as e:
+        with api.client.websocket_connect("/ws/chat", headers={"Authorization": "Bearer bad"}):
+            pass
+    assert e.value.code == 1008
+
+
+def test_auth_message_with_a_bad_token_closes_the_socket(api):
+    with api.client.websocket_connect("/ws/chat") as ws:
+        ws.send_json({"type": "auth", "token": "bad"})
+        with pytest.raises(WebSocketDisconnect) as e:
+            ws.receive_json()
+    assert e.value.code == 1008
+    assert api.llm_calls == []
+
+
+def test_one_connection_carries_many_turns(api):
+    with api.client.websocket_connect("/ws/chat") as ws:
+        ws.send_json({"type": "auth", "token": "good"})
+        events, first = _turn(ws, context="give me a workout", consent_granted=True)
+        assert events == ["start", "intent", "agent", "message"]
+        assert first["intent"] == "trainer"
+
+        # Consent and history carry over to the next turn on the same connection
+        events, second = _turn(ws, context="explain that")
+        assert second["intent"] == "trainer"
+        intent_prompt = [m.content for m in api.llm_inputs[api.llm_calls.index("intent", 1)]]
+        assert any("give me a workout" in text for text in intent_prompt)
+
+        ws.send_json({"type": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+
+
+def test_idle_connections_are_closed(api, monkeypatch):
+    monkeypatch.setattr(main, "WS_IDLE_TIMEOUT_SECONDS", 0.05)
+    with api.client.websocket_connect("/ws/chat", headers={"Authorization": "Bearer good"}) as ws:
+        with pytest.raises(WebSocketDisconnect) as e:
+            ws.receive_json()
+    assert e.value.code == 1000
+    assert e.value.reason == "idle timeout"
@@ -4,35 +4,88 @@ import logging
 from descope import DescopeClient
 from dotenv import load_dotenv
 import asyncio
+import time
+import hashlib
+from utils.resilience import call_with_resilience, UpstreamUnavailable
+from utils.profiling import profile_span
+from utils.shared_cache import get_cache
 
 load_dotenv()
 
 DESCOPE_PROJECT_ID = os.environ.get("DESCOPE_PROJECT_ID")
 descope_client = DescopeClient(project_id=DESCOPE_PROJECT_ID)
 
-async def verify_scope(token: str, required_scope: str) -> bool:
+# Validated claims are cached per token so repeated checks (every agent re-verifies
+# the same JWT, and WebSocket turns reuse one) skip the Descope round trip. The cache
+# is shared between workers. It is keyed on a hash of the token and holds only the
+# claims we use: validate_session() also returns the raw JWT ("jwt", "sessionToken.jwt"),
+# which must never reach disk.
+CACHED_CLAIMS = ("sub", "userId", "scope", "exp", "tenants", "dct")
+CLAIMS_CACHE_TTL_SECONDS = float(os.environ.get("CLAIMS_CACHE_TTL_SECONDS", "60"))
+CLAIMS_CACHE_MAX_ENTRIES = 10000
+_claims_cache = get_cache("claims", local_max=CLAIMS_CACHE_MAX_ENTRIES, default_ttl=CLAIMS_CACHE_TTL_SECONDS)
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def claims_expiry(claims: dict) -> float | None:
+    """Expiry (epoch seconds) of a validated session, if Descope reported one."""
+    exp = claims.get("exp") or (claims.get("sessionToken") or {}).get("exp")
+    return float(exp) if exp else None
+
+
+async def get_token_claims(token: str) -> dict | None:
     """
-    Verify that the given JWT contains the required scope using Descope.
-    Handles sync validate_session in async context.
+    Validate the JWT with Descope and return its claims (CACHED_CLAIMS only), or None if it is invalid.
+    Results are cached until the earlier of the token expiry and CLAIMS_CACHE_TTL_SECONDS.
+    Raises UpstreamUnavailable when Descope itself is failing, so an outage is not
+    reported to the user as an invalid token.
     """
+    now = time.time()
+    key = _token_key(token)
+    cached = await _claims_cache.get(key)
+    if cached is not None:
+        return cached
     try:
-        # Run validate_session in a thread if it is synchronous
-        resp = await asyncio.to_thread(descope_client.validate_session, token)
+        # Run validate_session in a thread since it is synchronous
+        with profile_span("descope", "validate_session"):
+            claims = await call_with_resilience("descope", lambda: asyncio.to_thread(descope_client.validate_session, token))
+    except UpstreamUnavailable:
+        raise
+    except Exception as e:
+        logging.warning("[DescopeUtils] Token verification failed: %s", e)
+        return None
 
-        # Log full response for debugging
-        logging.info(f"[DescopeUtils] validate_session response: {resp}")
+    logging.debug("[DescopeUtils] Session validated for subject %s", claims.get("sub"))
 
-        
-        scopes = resp.get("scope", [])
-        logging.info(f"[DescopeUtils] Extracted scopes: {scopes}")
+    expires_at = now + CLAIMS_CACHE_TTL_SECONDS
+    exp = claims_expiry(claims)
+    claims = {name: claims[name] for name in CACHED_CLAIMS if name in claims}
+    if exp:
+        claims["exp"] = exp
+        expires_at = min(expires_at, exp)
+    if expires_at > now:
+        await _claims_cache.set(key, claims, ttl=expires_at - now)
+    return claims
 
-        if required_scope in scopes:
-            logging.info(f"[DescopeUtils] Required scope '{required_scope}' verified")
-            return True
-        else:
-            logging.warning(f"[DescopeUtils] Missing required scope '{required_scope}'")
-            return False
 
-    except Exception as e:
-        logging.warning(f"[DescopeUtils] Token verification failed: {e}")
+async def verify_scope(token: str, required_scope: str) -> bool:
+    """
+    Verify that the given JWT contains the required scope using Descope.
+    Handles sync validate_session in async context.
+    """
+    resp = await get_token_claims(token)
+    if not resp:
+        return False
+
+    scopes = resp.get("scope", [])
+    logging.debug("[DescopeUtils] Extracted scopes: %s", scopes)
+
+    if required_scope in scopes:
+        logging.info("[DescopeUtils] Required scope '%s' verified", required_scope)
+        return True
+    else:
+        logging.warning("[DescopeUtils] Missing required scope '%s'", required_scope)
         return False
@@ -0,0 +1,238 @@
+# backend/utils/idempotency.py
+"""
+Idempotency keys for agent queries.
+
+A request carrying an Idempotency-Key is run at most once per key:
+
+- while the original is running in this worker, duplicates attach to it (and,
+  when streaming, first replay the events emitted so far);
+- while it is running in another worker, duplicates poll the shared store until
+  it completes or its lease runs out, in which case they take over;
+- once it has completed, duplicates get the stored result until
+  IDEMPOTENCY_TTL_SECONDS expires.
+
+Keys are scoped to the caller, and reusing a key with a different request body
+raises IdempotencyConflict. Failed runs are not stored, so a retry after an
+error runs again. IDEMPOTENCY_STORE picks the store: "sqlite" (default, shared by
+the workers on this host through shared_cache.SQLiteDatabase) or "memory" (per
+process).
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import orjson
+from utils import metrics
+from utils.shared_cache import SQLiteDatabase, dumps, loads
+
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "sqlite").lower()
+IDEMPOTENCY_DB_PATH = os.getenv(
+    "IDEMPOTENCY_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "idempotency.db"),
+)
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+# How long another worker waits for an in-flight original before taking over
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "120"))
+IDEMPOTENCY_POLL_SECONDS = 0.1
+_PURGE_EVERY_CLAIMS = 500
+
+IN_FLIGHT, DONE = "in_flight", "done"
+_RETRY = object()
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request (422), or its original is still running (409)."""
+
+    def __init__(self, message: str, status_code: int = 422):
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def request_fingerprint(*parts) -> str:
+    return hashlib.sha256(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def scoped_key(token: str, key: str) -> str:
+    """Scope a client-supplied key to the caller, so keys never collide across users."""
+    return f"{hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]}:{key}"
+
+
+class InMemoryIdempotencyStore:
+    def __init__(self):
+        self._records: dict[str, dict] = {}
+
+    async def claim(self, key: str, fingerprint: str, lease_seconds: float) -> dict | None:
+        """Atomically take the key, returning None; or return the live record that holds it."""
+        now = time.time()
+        record = self._records.get(key)
+        if record is not None and record["expires_at"] > now:
+            return record
+        self._records[key] = {"fingerprint": fingerprint, "status": IN_FLIGHT, "result": None, "expires_at": now + lease_seconds}
+        if len(self._records) % _PURGE_EVERY_CLAIMS == 0:
+            self._records = {k: r for k, r in self._records.items() if r["expires_at"] > now}
+        return None
+
+    async def complete(self, key: str, fingerprint: str, result, ttl_seconds: float):
+        self._records[key] = {"fingerprint": fingerprint, "status": DONE, "result": result, "expires_at": time.time() + ttl_seconds}
+
+    async def release(self, key: str):
+        self._records.pop(key, None)
+
+
+class SQLiteIdempotencyStore:
+    """Records in a SQLite-WAL database shared by the workers on this host."""
+
+    def __init__(self, path: str = IDEMPOTENCY_DB_PATH):
+        self.db = SQLiteDatabase(path, """
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status TEXT NOT NULL, result BLOB, expires_at REAL NOT NULL
+            );
+        """, "idempotency")
+        self._claims = 0
+
+    async def claim(self, key: str, fingerprint: str, lease_seconds: float) -> dict | None:
+        now = time.time()
+
+        def run(conn):
+            row = conn.execute("SELECT fingerprint, status, result, expires_at FROM idempotency WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[3] > now:
+                return {"fingerprint": row[0], "status": row[1], "result": loads(row[2]) if row[2] else None, "expires_at": row[3]}
+            conn.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, NULL, ?)", (key, fingerprint, IN_FLIGHT, now + lease_seconds))
+            self._claims += 1
+            if self._claims % _PURGE_EVERY_CLAIMS == 0:
+                conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (now,))
+            return None
+        return await self.db.write(run)
+
+    async def complete(self, key: str, fingerprint: str, result, ttl_seconds: float):
+        data = dumps(result)
+        await self.db.write(lambda conn: conn.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, ?, ?)",
+                                                      (key, fingerprint, DONE, data, time.time() + ttl_seconds)))
+
+    async def release(self, key: str):
+        await self.db.write(lambda conn: conn.execute("DELETE FROM idempotency WHERE key = ? AND status = ?", (key, IN_FLIGHT)))
+
+
+class _InFlight:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.events: list[dict] = []
+        self.listeners: list = []
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting on a failed original; do not warn about an unretrieved exception
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+class IdempotencyManager:
+    def __init__(self, store, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS, lease_seconds: float = IDEMPOTENCY_LEASE_SECONDS):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self._inflight: dict[str, _InFlight] = {}
+
+    async def run(self, key: str, fingerprint: str, compute, emit=None, store_result=None) -> tuple[dict, bool]:
+        """
+        Run `compute(emit)` once for `key` and return (result, replayed). `emit`, if
+        given, receives the streamed events, replayed ones included; duplicates that
+        attach to a run in another worker only get the final result. `store_result`
+        decides whether a completed result is kept for later duplicates.
+        """
+        deadline = time.monotonic() + self.lease_seconds
+        while True:
+            local = self._inflight.get(key)
+            if local is not None:
+                result = await self._attach(local, fingerprint, emit)
+                if result is _RETRY:
+                    continue
+                return result, True
+
+            record = await self.store.claim(key, fingerprint, self.lease_seconds)
+            if record is None:
+                return await self._run_owner(key, fingerprint, compute, emit, store_result), False
+            if record["fingerprint"] != fingerprint:
+                metrics.inc("idempotency_requests_total", result="conflict")
+                raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+            if record["status"] == DONE:
+                metrics.inc("idempotency_requests_total", result="replayed")
+                return record["result"], True
+            if time.monotonic() >= deadline:
+                metrics.inc("idempotency_requests_total", result="timeout")
+                raise IdempotencyConflict("The original request with this Idempotency-Key is still in progress", 409)
+            # In flight in another worker: wait for it to finish, fail or lose its lease
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    async def _attach(self, local: _InFlight, fingerprint: str, emit):
+        if local.fingerprint != fingerprint:
+            metrics.inc("idempotency_requests_total", result="conflict")
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+        metrics.inc("idempotency_requests_total", result="attached")
+        if emit is not None:
+            for event in list(local.events):
+                await emit(event)
+            local.listeners.append(emit)
+        try:
+            # wait() rather than shield(): our own cancellation must not cancel the original
+            await asyncio.wait({local.future})
+        finally:
+            if emit is not None and emit in local.listeners:
+                local.listeners.remove(emit)
+        return _RETRY if local.future.cancelled() else local.future.result()
+
+    async def _run_owner(self, key: str, fingerprint: str, compute, emit, store_result):
+        local = _InFlight(fingerprint)
+        self._inflight[key] = local
+        metrics.inc("idempotency_requests_total", result="executed")
+
+        async def tee(event: dict):
+            local.events.append(event)
+            if emit is not None:
+                await emit(event)
+            for listener in list(local.listeners):
+                try:
+                    await listener(event)
+                except Exception as e:
+                    # A duplicate's slow or closed consumer must not fail the original
+                    logging.warning("[Idempotency] Dropping attached listener: %s", e)
+                    local.listeners.remove(listener)
+
+        try:
+            result = await compute(tee)
+            if store_result is None or store_result(result):
+                try:
+                    await self.store.complete(key, fingerprint, result, self.ttl_seconds)
+                except (sqlite3.Error, TypeError) as e:
+                    logging.warning("[Idempotency] Could not store result: %s", e)
+                    await self.store.release(key)
+            else:
+                await self.store.release(key)
+        except Exception as e:
+            await self.store.release(key)
+            local.future.set_exception(e)
+            raise
+        except BaseException:
+            # The original was cancelled; attached duplicates start over and one of them takes the key.
+            # Shielded, so a repeated cancellation cannot leave the key claimed until its lease runs out.
+            local.future.cancel()
+            await asyncio.shield(self.store.release(key))
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        local.future.set_result(result)
+        return result
+
+
+def make_store(kind: str = IDEMPOTENCY_STORE):
+    if kind == "memory":
+        return InMemoryIdempotencyStore()
+    if kind != "sqlite":
+        raise ValueError(f"IDEMPOTENCY_STORE must be 'sqlite' or 'memory', got '{kind}'")
+    try:
+        return SQLiteIdempotencyStore()
+    except sqlite3.Error as e:
+        logging.warning("[Idempotency] Could not open %s, using a per-process store: %s", IDEMPOTENCY_DB_PATH, e)
+        return InMemoryIdempotencyStore()
+
+
+idempotency = IdempotencyManager(make_store())
@@ -0,0 +1,150 @@
+# backend/utils/llm_cassette.py
+"""
+Record/replay layer for OpenAI chat calls, at the httpx transport level.
+
+Every chat model built by utils.model_router.get_chat_model goes through this
+transport when LLM_CASSETTE_MODE is set:
+
+    off     live calls only (default)
+    record  live calls; every successful response is written to the cassette
+    replay  serve recorded responses; misses go live and are recorded
+    strict  serve recorded responses; a miss never reaches OpenAI and fails the
+            whole run with CassetteMiss (never retried or degraded)
+
+Recordings are keyed on a SHA-256 of the canonical request (path, model, params
+and messages) and stored content-addressed as gzipped JSON under
+LLM_CASSETTE_DIR/<key[:2]>/<key>.json.gz. LLM_CASSETTE_LATENCY controls replay
+delay: "0" (default, no delay), "recorded" (original latency) or a number of ms.
+"""
+import os
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import httpx
+import openai
+from utils import metrics
+
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+LLM_CASSETTE_DIR = os.getenv(
+    "LLM_CASSETTE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cassettes"),
+)
+LLM_CASSETTE_LATENCY = os.getenv("LLM_CASSETTE_LATENCY", "0").lower()
+
+CASSETTE_MODES = ("off", "record", "replay", "strict")
+
+
+class CassetteMiss(Exception):
+    """Strict mode has no recording for an LLM call."""
+
+
+def raise_on_cassette_miss(e: Exception):
+    """Re-raise the 404 the transport returns for a strict-mode miss as CassetteMiss."""
+    if isinstance(e, openai.NotFoundError) and e.code == "cassette_miss":
+        raise CassetteMiss(e.body.get("message") if isinstance(e.body, dict) else e.message) from e
+
+
+def request_key(path: str, body: bytes) -> str:
+    """Stable hash of a request: key order and whitespace in the JSON body do not matter."""
+    try:
+        canonical = json.dumps(json.loads(body or b"{}"), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        canonical = body.decode("utf-8", "replace")
+    return hashlib.sha256(f"{path}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+class CassetteStore:
+    """Content-addressed on-disk store of recorded responses."""
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory or LLM_CASSETTE_DIR
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+
+    def get(self, key: str) -> dict | None:
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, entry: dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(entry, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, mode: str | None = None, store: CassetteStore | None = None,
+                 latency: str | None = None, wrapped: httpx.AsyncBaseTransport | None = None):
+        mode = mode or LLM_CASSETTE_MODE
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"LLM_CASSETTE_MODE must be one of {CASSETTE_MODES}, got '{mode}'")
+        self.mode = mode
+        self.store = store or CassetteStore()
+        self.latency = latency or LLM_CASSETTE_LATENCY
+        self.wrapped = wrapped or httpx.AsyncHTTPTransport()
+
+    async def _simulate_latency(self, entry: dict):
+        if self.latency in ("0", "", "none"):
+            return
+        delay = entry.get("latency", 0) if self.latency == "recorded" else float(self.latency) / 1000
+        await asyncio.sleep(delay)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.url.path, body)
+
+        if self.mode in ("replay", "strict"):
+            entry = self.store.get(key)
+            if entry is not None:
+                metrics.inc("llm_cassette_total", result="hit")
+                await self._simulate_latency(entry)
+                return httpx.Response(entry["status"], headers={"content-type": entry["content_type"]},
+                                      content=entry["body"].encode("utf-8"), request=request)
+            metrics.inc("llm_cassette_total", result="miss")
+            if self.mode == "strict":
+                # An exception here would be wrapped by the OpenAI client as a retryable connection
+                # error; a 404 fails the call immediately, and call_llm turns it into CassetteMiss
+                message = f"No cassette recording for {request.url.path} (key {key[:12]}); record it with LLM_CASSETTE_MODE=record"
+                logging.error("[Cassette] %s", message)
+                return httpx.Response(404, json={"error": {"message": message, "type": "cassette_miss", "code": "cassette_miss"}},
+                                      request=request)
+
+        start = time.perf_counter()
+        response = await self.wrapped.handle_async_request(request)
+        content = await response.aread()
+        latency = time.perf_counter() - start
+        if 200 <= response.status_code < 300:
+            self.store.put(key, {
+                "request": json.loads(body or b"{}"),
+                "status": response.status_code,
+                "content_type": response.headers.get("content-type", "application/json"),
+                "body": content.decode("utf-8"),
+                "latency": round(latency, 4),
+            })
+            metrics.inc("llm_cassette_total", result="recorded")
+            logging.info("[Cassette] Recorded %s (%s)", request.url.path, key[:12])
+        # The body has been read and decoded, so drop encoding/length headers from the original
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")}
+        return httpx.Response(response.status_code, headers=headers, content=content, request=request)
+
+    async def aclose(self):
+        await self.wrapped.aclose()
+
+
+def cassette_async_client(api_key: str | None, max_retries: int = 2):
+    """An AsyncOpenAI chat-completions client behind the cassette, or None when the cassette is off."""
+    if LLM_CASSETTE_MODE == "off":
+        return None
+    http_client = httpx.AsyncClient(transport=CassetteTransport(), timeout=httpx.Timeout(600, connect=5))
+    # Replays never reach OpenAI, so a key is only needed when recording
+    client = openai.AsyncOpenAI(api_key=api_key or "cassette-replay", max_retries=max_retries, http_client=http_client)
+    return client.chat.completions
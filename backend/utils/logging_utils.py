@@ -0,0 +1,172 @@
+# backend/utils/logging_utils.py
+import os
+import re
+import sys
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import logging.handlers
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "text"
+# Per-logger sampling of sub-WARNING records, e.g. "Fitbit=0.1,DescopeUtils=0.2,httpx=0".
+# Keys match either the logger name or the "[Tag]" prefix the backend puts on messages.
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+REDACTED = "[REDACTED]"
+# Structured fields whose values are never written
+SENSITIVE_KEYS = re.compile(r"token|secret|password|authorization|api_key|code_verifier|cookie|email|phone", re.IGNORECASE)
+_MESSAGE_PATTERNS = [
+    # JWTs (Descope session tokens, Fitbit access tokens)
+    (re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]*"), REDACTED),
+    (re.compile(r"(Bearer\s+)\S+", re.IGNORECASE), r"\1" + REDACTED),
+    # key: value / key=value pairs in dict reprs and JSON bodies
+    (re.compile(r"""(['"]?(?:access_token|refresh_token|id_token|token|client_secret|password|code_verifier)['"]?\s*[:=]\s*)(['"])[^'"]*\2""", re.IGNORECASE),
+     r"\1\2" + REDACTED + r"\2"),
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), REDACTED),
+]
+
+_TAG = re.compile(r"^\[([^\]]+)\]")
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def redact_text(text: str) -> str:
+    for pattern, replacement in _MESSAGE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_fields(value):
+    """Recursively mask sensitive keys in structured data."""
+    if isinstance(value, dict):
+        return {k: REDACTED if SENSITIVE_KEYS.search(str(k)) else redact_fields(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact_fields(v) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+def record_tag(record: logging.LogRecord) -> str | None:
+    match = _TAG.match(record.msg) if isinstance(record.msg, str) else None
+    return match.group(1) if match else None
+
+
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of sub-WARNING records per logger/tag; WARNING and above are always kept."""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None:
+            rate = self.rates.get(record_tag(record) or "", 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue a snapshot of the record. The message is merged with its args (and a
+    traceback rendered) in the calling thread, since the args may be mutated once
+    the call returns; JSON encoding, redaction and I/O happen on the listener thread.
+    Records below the logger's level never get here, so filtered calls stay free.
+    """
+
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with redaction applied to the message and extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact_text(record.getMessage()),
+        }
+        tag = record_tag(record)
+        if tag:
+            entry["tag"] = tag
+        extra = {k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS}
+        if extra:
+            entry.update(redact_fields(extra))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = redact_text(record.exc_text)
+        return json.dumps(entry, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return redact_text(super().format(record))
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, sample_rates: str = LOG_SAMPLE_RATES, stream=None):
+    """
+    Route all logging through a non-blocking queue. The root logger gets a queue
+    handler (plus the sampling filter); a background listener thread formats,
+    redacts and writes the records to `stream` (stderr by default).
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else RedactingFormatter("%(levelname)s:%(name)s:%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(parse_sample_rates(sample_rates)))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,96 @@
+# backend/utils/metrics.py
+import threading
+
+# Histogram buckets in seconds, tuned for upstream/LLM latencies
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters: dict[tuple, float] = {}
+_gauges: dict[tuple, float] = {}
+_histograms: dict[tuple, list] = {}
+_kinds: dict[str, str] = {}
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Increment a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _kinds.setdefault(name, "counter")
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    """Set a gauge to an absolute value."""
+    key = _key(name, labels)
+    with _lock:
+        _kinds.setdefault(name, "gauge")
+        _gauges[key] = value
+
+
+def observe(name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+    """Record a value in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        _kinds.setdefault(name, "histogram")
+        hist = _histograms.get(key)
+        if hist is None:
+            # [bucket bounds, bucket counts, sum, count]
+            hist = _histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(hist[0]):
+            if value <= bound:
+                hist[1][i] += 1
+        hist[2] += value
+        hist[3] += 1
+
+
+def snapshot() -> dict:
+    """Plain-dict copy of every metric, keyed by name then label tuple."""
+    with _lock:
+        out: dict[str, dict] = {}
+        for (name, labels), value in _counters.items():
+            out.setdefault(name, {})[labels] = value
+        for (name, labels), value in _gauges.items():
+            out.setdefault(name, {})[labels] = value
+        for (name, labels), (_, _, total, count) in _histograms.items():
+            out.setdefault(name, {})[labels] = {"sum": total, "count": count}
+        return out
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, kind in sorted(_kinds.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                series = [(k, v) for k, v in _counters.items() if k[0] == name]
+            elif kind == "gauge":
+                series = [(k, v) for k, v in _gauges.items() if k[0] == name]
+            else:
+                for (hist_name, labels), (bounds, counts, total, count) in _histograms.items():
+                    if hist_name != name:
+                        continue
+                    for bound, bucket_count in zip(bounds, counts):
+                        lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+                continue
+            for (_, labels), value in series:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
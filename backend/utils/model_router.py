@@ -0,0 +1,143 @@
+# backend/utils/model_router.py
+import os
+import json
+import time
+import logging
+from functools import lru_cache
+from pydantic import BaseModel
+from langchain_community.chat_models import ChatOpenAI
+from langchain_core.messages import SystemMessage
+from utils import metrics
+from utils.resilience import call_llm
+from utils.llm_cassette import cassette_async_client
+from utils.prompt_builder import BuiltPrompt, count_tokens, record_usage
+
+MODEL_ROUTING_CONFIG = os.getenv(
+    "MODEL_ROUTING_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "model_routing.json"),
+)
+
+
+class Tier(BaseModel):
+    model: str
+    max_tokens: int
+    temperature: float = 0.7
+
+
+class RuleCondition(BaseModel):
+    intents: list[str] | None = None
+    plan_keywords: bool | None = None
+    personalized: bool | None = None
+    min_chars: int | None = None
+    max_chars: int | None = None
+
+
+class Rule(BaseModel):
+    tier: str
+    when: RuleCondition
+
+
+class RoutingConfig(BaseModel):
+    default_tier: str
+    tiers: dict[str, Tier]
+    plan_keywords: list[str] = []
+    rules: list[Rule] = []
+
+
+class Route(BaseModel):
+    tier: str
+    model: str
+    max_tokens: int
+    temperature: float
+
+
+# ~0.75 words per token, with headroom so the answer ends before the cap cuts it off
+WORDS_PER_TOKEN_BUDGET = 0.6
+
+
+@lru_cache(maxsize=1)
+def load_config(path: str = MODEL_ROUTING_CONFIG) -> RoutingConfig:
+    with open(path) as f:
+        config = RoutingConfig(**json.load(f))
+    unknown = ({r.tier for r in config.rules} | {config.default_tier}) - set(config.tiers)
+    if unknown:
+        raise ValueError(f"Model routing config references unknown tiers: {sorted(unknown)}")
+    return config
+
+
+def query_features(agent: str, state: dict, config: RoutingConfig) -> dict:
+    """Cheap local features of the current turn used for routing."""
+    query = (state.get("user_query") or "").lower()
+    return {
+        "chars": len(query),
+        "intent": state.get("intent") or agent,
+        "plan_keywords": any(k in query for k in config.plan_keywords),
+        "personalized": bool(state.get("fitbit_linked")) or any(
+            state.get(k) is not None for k in ["manual_sleep_hours", "manual_protein_grams", "manual_calories_burned"]
+        ),
+    }
+
+
+def _matches(cond: RuleCondition, features: dict, agent: str) -> bool:
+    if cond.intents is not None and features["intent"] not in cond.intents and agent not in cond.intents:
+        return False
+    if cond.plan_keywords is not None and features["plan_keywords"] != cond.plan_keywords:
+        return False
+    if cond.personalized is not None and features["personalized"] != cond.personalized:
+        return False
+    if cond.min_chars is not None and features["chars"] < cond.min_chars:
+        return False
+    if cond.max_chars is not None and features["chars"] > cond.max_chars:
+        return False
+    return True
+
+
+def route(agent: str, state: dict) -> Route:
+    """Pick a tier for an agent call: first matching rule wins, else the default tier."""
+    config = load_config()
+    features = query_features(agent, state, config)
+    tier_name = next((r.tier for r in config.rules if _matches(r.when, features, agent)), config.default_tier)
+    tier = config.tiers[tier_name]
+    logging.info("[Router] %s -> tier '%s' (%s, max_tokens=%s) features=%s", agent, tier_name, tier.model, tier.max_tokens, features)
+    metrics.inc("llm_route_total", agent=agent, tier=tier_name)
+    return Route(tier=tier_name, model=tier.model, max_tokens=tier.max_tokens, temperature=tier.temperature)
+
+
+@lru_cache(maxsize=32)
+def get_chat_model(model: str, max_tokens: int | None, temperature: float, api_key: str | None) -> ChatOpenAI:
+    """
+    Single factory for chat models. They are reused per (model, cap, temperature, key)
+    instead of rebuilt on every call, and go through the LLM cassette when it is enabled.
+    """
+    kwargs = {}
+    async_client = cassette_async_client(api_key)
+    if async_client is not None:
+        kwargs["async_client"] = async_client
+    return ChatOpenAI(model_name=model, temperature=temperature, max_tokens=max_tokens, openai_api_key=api_key, **kwargs)
+
+
+def with_length_budget(prompt: BuiltPrompt, selected: Route) -> BuiltPrompt:
+    """
+    Tell the model the tier's output budget, so a capped answer is written to fit instead of
+    being cut off mid-sentence. It goes in just before the user turn, after the cacheable prefix.
+    """
+    words = int(selected.max_tokens * WORDS_PER_TOKEN_BUDGET)
+    instruction = f"Keep your answer under {words} words and finish your last sentence."
+    messages = prompt.messages[:-1] + [SystemMessage(content=instruction), prompt.messages[-1]]
+    return BuiltPrompt(prompt.name, messages, {**prompt.sections, "length_budget": count_tokens(instruction)})
+
+
+async def invoke_agent_llm(agent: str, state: dict, prompt: BuiltPrompt, api_key: str | None):
+    """Route an agent LLM call to a tier, invoke it, and record per-tier latency/token usage."""
+    selected = route(agent, state)
+    prompt = with_length_budget(prompt, selected)
+    llm = get_chat_model(selected.model, selected.max_tokens, selected.temperature, api_key)
+    start = time.perf_counter()
+    response = await call_llm(llm, prompt.messages, name=agent, tier=selected.tier)
+    metrics.observe("llm_call_latency_seconds", time.perf_counter() - start, agent=agent, tier=selected.tier)
+
+    await record_usage(agent, response, prompt, tier=selected.tier, model=selected.model)
+    response_metadata = getattr(response, "response_metadata", None) or {}
+    if response_metadata.get("finish_reason") == "length":
+        metrics.inc("llm_truncated_total", agent=agent, tier=selected.tier)
+    return response
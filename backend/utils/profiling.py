@@ -0,0 +1,236 @@
+# backend/utils/profiling.py
+"""
+On-demand per-request profiling.
+
+A request is profiled when it carries `X-Profile: <PROFILE_ADMIN_TOKEN>` or is
+picked by PROFILE_SAMPLE_RATE. For that request we capture:
+
+- a sampled stack profile of the event loop thread and busy worker threads
+  (asyncio.to_thread validations), written as <profile_id>.collapsed, which
+  speedscope and flamegraph.pl open directly;
+- an asyncio task timeline of profile_span() sections (Descope validations,
+  LLM awaits, Fitbit awaits, agents, the merge loop), written as
+  <profile_id>.speedscope.json with one lane per task plus per-kind totals.
+
+Files go to PROFILE_DIR and the id is returned in the X-Profile-Id header; only
+the newest PROFILE_MAX_FILES profiles are kept there. The id is always generated
+server-side; a well-formed client X-Request-Id is only recorded inside the profile.
+Stack samples cover the whole process, so other requests running concurrently
+also show up in the collapsed file; the timeline is per request.
+Requests without the trigger only pay for one header lookup, and
+profile_span() outside a profiled request is a ContextVar read.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import re
+import uuid
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# Profiles kept in PROFILE_DIR; older ones are deleted as new ones are written
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "profiles"),
+)
+
+_current_profile: ContextVar["RequestProfile | None"] = ContextVar("current_profile", default=None)
+# Only one stack sampler runs at a time; concurrent profiled requests get the timeline only
+_sampler_lock = threading.Lock()
+_REQUEST_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# Leaf frames of worker threads that are waiting for work rather than doing it
+_IDLE_LEAVES = {"_worker", "wait", "get", "dequeue"}
+_PROFILE_SUFFIXES = (".speedscope.json", ".collapsed")
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, loop_thread_id: int, interval: float = PROFILE_INTERVAL_SECONDS):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.counts: Counter[str] = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                is_loop = thread_id == self.loop_thread_id
+                if not is_loop and frame.f_code.co_name in _IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append("event-loop" if is_loop else names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class RequestProfile:
+    def __init__(self, profile_id: str, path: str, request_id: str | None = None):
+        self.profile_id = profile_id
+        self.request_id = request_id
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans: list[tuple[str, str, str, float, float]] = []
+        self.sampler: StackSampler | None = None
+
+    def start_sampler(self):
+        if _sampler_lock.acquire(blocking=False):
+            self.sampler = StackSampler(threading.get_ident())
+            self.sampler.start()
+
+    def stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            _sampler_lock.release()
+
+    def record(self, kind: str, name: str, task: str, start: float, end: float):
+        self.spans.append((kind, name, task, start - self.start, end - self.start))
+
+    def timeline(self) -> dict:
+        """Speedscope 'evented' file: one profile (lane) per asyncio task."""
+        frames, frame_index, lanes = [], {}, {}
+        for kind, name, task, start, end in self.spans:
+            label = f"{kind}:{name}"
+            if label not in frame_index:
+                frame_index[label] = len(frames)
+                frames.append({"name": label})
+            lanes.setdefault(task, []).append((start, end, frame_index[label]))
+
+        profiles = []
+        for task, spans in lanes.items():
+            events = []
+            for start, end, frame in spans:
+                events.append({"type": "O", "frame": frame, "at": start * 1000})
+                events.append({"type": "C", "frame": frame, "at": end * 1000})
+            # Close before open at equal timestamps, and outer spans open first / close last
+            events.sort(key=lambda e: (e["at"], e["type"] == "O"))
+            profiles.append({
+                "type": "evented", "name": task, "unit": "milliseconds",
+                "startValue": 0, "endValue": max(e["at"] for e in events), "events": events,
+            })
+
+        totals = Counter()
+        for kind, _, _, start, end in self.spans:
+            totals[kind] += (end - start) * 1000
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.path} {self.request_id or self.profile_id}",
+            "exporter": "fitness-backend",
+            "request_id": self.request_id,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "totals_ms": {k: round(v, 2) for k, v in totals.items()},
+        }
+
+    def write(self, directory: str = PROFILE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.profile_id)
+        with open(f"{base}.speedscope.json", "w") as f:
+            json.dump(self.timeline(), f)
+        if self.sampler is not None:
+            with open(f"{base}.collapsed", "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in self.sampler.counts.most_common())
+        prune_profiles(directory)
+        return base
+
+
+def prune_profiles(directory: str = PROFILE_DIR, keep: int = PROFILE_MAX_FILES):
+    """Delete all but the newest `keep` profiles (both files of a profile go together)."""
+    newest: dict[str, float] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            suffix = next((s for s in _PROFILE_SUFFIXES if entry.name.endswith(s)), None)
+            if suffix and entry.is_file():
+                profile_id = entry.name[:-len(suffix)]
+                newest[profile_id] = max(newest.get(profile_id, 0), entry.stat().st_mtime)
+    for profile_id in sorted(newest, key=newest.get, reverse=True)[max(keep, 0):]:
+        for suffix in _PROFILE_SUFFIXES:
+            try:
+                os.remove(os.path.join(directory, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def profile_span(kind: str, name: str = ""):
+    """Time a section (usually around an await) on the current request's timeline, if it is being profiled."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    task = asyncio.current_task()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record(kind, name, task.get_name() if task else threading.current_thread().name, start, time.perf_counter())
+
+
+def _should_profile(headers: list) -> bool:
+    if PROFILE_ADMIN_TOKEN:
+        for key, value in headers:
+            if key == b"x-profile":
+                return hmac.compare_digest(value, PROFILE_ADMIN_TOKEN.encode("utf-8"))
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware, so untriggered requests skip all profiling machinery."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope["headers"]):
+            await self.app(scope, receive, send)
+            return
+
+        # Never build file names from client input; a valid X-Request-Id is kept as metadata only
+        request_id = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"x-request-id"), None)
+        if request_id is not None and not _REQUEST_ID_RE.fullmatch(request_id):
+            request_id = None
+        profile_id = uuid.uuid4().hex
+        profile = RequestProfile(profile_id, scope["path"], request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", profile_id.encode("latin-1"))]
+            await send(message)
+
+        token = _current_profile.set(profile)
+        profile.start_sampler()
+        try:
+            with profile_span("request", scope["path"]):
+                await self.app(scope, receive, send_with_id)
+        finally:
+            profile.stop_sampler()
+            _current_profile.reset(token)
+            try:
+                base = await asyncio.to_thread(profile.write)
+                logging.info("[Profiling] Wrote profile %s (request %s) to %s.*", profile_id, request_id, base)
+            except Exception as e:
+                logging.warning("[Profiling] Could not write profile %s: %s", profile_id, e)
@@ -0,0 +1,211 @@
+# backend/utils/prompt_builder.py
+"""
+Central prompt assembly.
+
+Prompts are registered once at import time (register_prompt) and built per call
+with CompiledPrompt.build(). Messages are always laid out most-stable first, so
+OpenAI's automatic prefix caching can reuse the front of the prompt across turns:
+
+    1. system prompt (+ tool descriptions)     fixed per prompt
+    2. summary of older history                 changes once per history block
+    3. recent history, oldest first             append-only within a block
+    4. per-call context (metrics, advice)       changes every call
+    5. the current user turn
+
+History is trimmed and summarized in whole blocks of PROMPT_HISTORY_BLOCK turns
+rather than as a sliding window, since a sliding window changes the very first
+history message, and so the whole cached prefix, on every turn.
+
+Per-section token counts are local estimates, used only to show where a prompt's
+size comes from (the "sections" and "estimated_prompt_tokens" usage fields). They
+use tiktoken's o200k_base encoding when it is already in tiktoken's local cache
+(TIKTOKEN_CACHE_DIR; fill it at build time with
+`python -c "import tiktoken; tiktoken.get_encoding('o200k_base')"`), else ~4
+characters per token. The encoding is never downloaded at runtime, so startup
+does not depend on outbound network access.
+Quotas and cost are never based on them: the actual prompt/cached/completion
+counts reported by OpenAI are collected per call into the request's usage list
+(see begin_usage).
+"""
+import os
+import hashlib
+import logging
+import tempfile
+from functools import lru_cache
+from contextvars import ContextVar
+from langchain.prompts import HumanMessagePromptTemplate
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from utils import metrics, quota
+
+_ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken"
+
+PROMPT_HISTORY_MAX_TURNS = int(os.getenv("PROMPT_HISTORY_MAX_TURNS", "15"))
+PROMPT_HISTORY_BLOCK = int(os.getenv("PROMPT_HISTORY_BLOCK", "5"))
+# Turns older than this are folded into the summary message (in whole blocks)
+PROMPT_RECENT_TURNS = int(os.getenv("PROMPT_RECENT_TURNS", "6"))
+SUMMARY_CHARS_PER_TURN = 160
+
+_usage: ContextVar[list | None] = ContextVar("llm_usage", default=None)
+
+
+def _cached_encoding_path() -> str:
+    # Where tiktoken keeps a downloaded encoding: <cache dir>/<sha1 of its URL>
+    cache_dir = os.getenv("TIKTOKEN_CACHE_DIR") or os.getenv("DATA_GYM_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    return os.path.join(cache_dir, hashlib.sha1(_ENCODING_URL.encode()).hexdigest())
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """o200k_base if tiktoken is installed and the encoding is cached locally, else None. Loaded on first use."""
+    try:
+        import tiktoken
+    except ImportError:
+        logging.warning("[Prompt] tiktoken not installed; token counts are estimated from text length")
+        return None
+    if not os.path.exists(_cached_encoding_path()):
+        logging.warning("[Prompt] o200k_base is not in the tiktoken cache; token counts are estimated from text length")
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning("[Prompt] Could not load o200k_base (%s); token counts are estimated from text length", e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Estimated token count of `text`; exact for o200k_base models only when the encoding is cached locally."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return max(1, len(text) // 4)
+
+
+def trim_history(history: list[dict], max_turns: int = PROMPT_HISTORY_MAX_TURNS, block: int = PROMPT_HISTORY_BLOCK) -> list[dict]:
+    """Drop the oldest turns in whole blocks, so the retained history keeps its first turn for `block` turns."""
+    excess = len(history) - max_turns
+    if excess <= 0:
+        return history
+    drop = -(-excess // block) * block
+    return history[drop:]
+
+
+def _turn_text(turn: dict) -> str:
+    return turn.get("content") or turn.get("text") or ""
+
+
+def summarize_turns(turns: list[dict]) -> str:
+    """Deterministic extractive summary: role and the start of each older turn."""
+    lines = []
+    for turn in turns:
+        text = " ".join(_turn_text(turn).split())
+        if len(text) > SUMMARY_CHARS_PER_TURN:
+            text = text[:SUMMARY_CHARS_PER_TURN].rsplit(" ", 1)[0] + "..."
+        lines.append(f"{turn.get('role', 'user')}: {text}")
+    return "Summary of the earlier conversation:\n" + "\n".join(lines)
+
+
+class BuiltPrompt:
+    def __init__(self, name: str, messages: list, sections: dict[str, int]):
+        self.name = name
+        self.messages = messages
+        self.sections = sections
+
+
+class CompiledPrompt:
+    """A prompt whose static parts are built and counted once, at registration."""
+
+    def __init__(self, name: str, system: str, user_template: str = "{user_query}", tools: str = ""):
+        self.name = name
+        system_text = f"{system}\n\nAvailable tools:\n{tools}" if tools else system
+        self.system_message = SystemMessage(content=system_text)
+        self.system_tokens = count_tokens(system_text)
+        self.user_template = HumanMessagePromptTemplate.from_template(user_template)
+
+    def build(self, history: list[dict] | None = None, context: str = "", **user_vars) -> BuiltPrompt:
+        """
+        Assemble the messages for one call. `history` is a list of {"role", "content"}
+        turns, oldest first; the latest user turn is dropped if it repeats the current query.
+        User-supplied text only ever fills template variables, so it needs no escaping.
+        """
+        history = list(history or [])
+        user_query = user_vars.get("user_query")
+        last_user = next((i for i in range(len(history) - 1, -1, -1) if history[i].get("role") == "user"), None)
+        if last_user is not None and _turn_text(history[last_user]) == user_query:
+            del history[last_user]
+        history = trim_history(history)
+
+        messages = [self.system_message]
+        sections = {"system": self.system_tokens}
+
+        older = max(0, (len(history) - PROMPT_RECENT_TURNS) // PROMPT_HISTORY_BLOCK * PROMPT_HISTORY_BLOCK)
+        if older:
+            summary = summarize_turns(history[:older])
+            messages.append(SystemMessage(content=summary))
+            sections["history_summary"] = count_tokens(summary)
+
+        recent_tokens = 0
+        for turn in history[older:]:
+            text = _turn_text(turn)
+            if not text:
+                continue
+            messages.append(AIMessage(content=text) if turn.get("role") == "assistant" else HumanMessage(content=text))
+            recent_tokens += count_tokens(text)
+        if recent_tokens:
+            sections["history"] = recent_tokens
+
+        if context:
+            messages.append(HumanMessage(content=context))
+            sections["context"] = count_tokens(context)
+
+        user_message = self.user_template.format(**user_vars)
+        messages.append(user_message)
+        sections["user"] = count_tokens(user_message.content)
+        return BuiltPrompt(self.name, messages, sections)
+
+
+PROMPTS: dict[str, CompiledPrompt] = {}
+
+
+def register_prompt(name: str, system: str, user_template: str = "{user_query}", tools: str = "") -> CompiledPrompt:
+    PROMPTS[name] = CompiledPrompt(name, system, user_template, tools)
+    return PROMPTS[name]
+
+
+def get_prompt(name: str) -> CompiledPrompt:
+    return PROMPTS[name]
+
+
+def begin_usage() -> list[dict]:
+    """Start collecting per-call token usage for the current request (and the tasks it spawns)."""
+    usage = []
+    _usage.set(usage)
+    return usage
+
+
+def response_usage(response) -> dict[str, int]:
+    """Prompt/cached/completion token counts from an OpenAI chat response's metadata."""
+    token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+    details = token_usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": token_usage.get("prompt_tokens") or 0,
+        "cached_tokens": details.get("cached_tokens") or 0,
+        "completion_tokens": token_usage.get("completion_tokens") or 0,
+    }
+
+
+async def record_usage(agent: str, response, prompt: BuiltPrompt | None = None, tier: str = "orchestrator",
+                       model: str | None = None) -> dict:
+    """Record one LLM call's token usage in metrics, the current request's usage list and quotas."""
+    entry = {"agent": agent, "tier": tier, "model": model, **response_usage(response)}
+    if prompt is not None:
+        entry["estimated_prompt_tokens"] = sum(prompt.sections.values())
+        entry["sections"] = prompt.sections
+    for kind in ("prompt", "cached", "completion"):
+        metrics.inc("llm_tokens_total", entry[f"{kind}_tokens"], agent=agent, tier=tier, kind=kind)
+    usage = _usage.get()
+    if usage is not None:
+        usage.append(entry)
+    await quota.charge_call(entry)
+    return entry
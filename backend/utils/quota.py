@@ -0,0 +1,413 @@
+# backend/utils/quota.py
+"""
+Per-user and per-tenant quotas on requests, LLM calls and tokens.
+
+Each (scope, dimension) pair is a token bucket: `capacity` is the burst and
+`per_minute` the refill rate, both read from QUOTA_CONFIG (config/quotas.json).
+A dimension missing from the config, or with capacity 0, is unlimited.
+
+The orchestrator calls admit() for a verified user before any LLM call: it takes
+one request plus the estimated budget (one call, estimated_tokens_per_call
+tokens) of the intent call. Once intent classification has told it which agents
+will run, reserve() takes the estimated budget of the planned fan-out before any
+of them start. Either raises QuotaExceeded, taking nothing, if a bucket of the
+user or their tenant is short; users without a Descope tenant have no tenant
+scope. Every LLM call of an admitted request is settled against what it reserved
+via charge_call(): usage beyond the reservation is charged and may drive a
+bucket negative (the overdraft is paid back before the next request is let in),
+and finish_request() refunds what was reserved but not used. Cumulative per-day
+usage and estimated cost are kept per scope for usage_summary().
+
+QUOTA_STORE picks where buckets and usage live: "sqlite" (default, shared by the
+workers on this host, run off the event loop by shared_cache.SQLiteDatabase) or
+"memory" (per process). Each admission or charge is one transaction.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import datetime
+from functools import lru_cache
+from contextvars import ContextVar
+from pydantic import BaseModel
+from utils import metrics
+from utils.shared_cache import SQLiteDatabase
+
+QUOTA_CONFIG = os.getenv(
+    "QUOTA_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "quotas.json"),
+)
+QUOTA_STORE = os.getenv("QUOTA_STORE", "sqlite").lower()
+QUOTA_DB_PATH = os.getenv(
+    "QUOTA_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "quota.db"),
+)
+QUOTAS_ENABLED = os.getenv("QUOTAS_ENABLED", "true").lower() == "true"
+
+DIMENSIONS = ("requests", "llm_calls", "tokens")
+USAGE_COUNTERS = ("requests", "llm_calls", "prompt_tokens", "cached_tokens", "completion_tokens", "cost_usd")
+
+
+class Bucket(BaseModel):
+    capacity: float
+    per_minute: float
+
+
+class Price(BaseModel):
+    prompt: float
+    cached: float
+    completion: float
+
+
+class QuotaConfig(BaseModel):
+    user: dict[str, Bucket] = {}
+    tenant: dict[str, Bucket] = {}
+    estimated_tokens_per_call: int = 1000
+    agent_calls: dict[str, int] = {}
+    prices_per_million_tokens: dict[str, Price] = {}
+
+
+@lru_cache(maxsize=1)
+def load_config(path: str = QUOTA_CONFIG) -> QuotaConfig:
+    with open(path) as f:
+        config = QuotaConfig(**json.load(f))
+    unknown = (set(config.user) | set(config.tenant)) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Quota config has unknown dimensions: {sorted(unknown)}")
+    return config
+
+
+class QuotaExceeded(Exception):
+    """A bucket is short. `retry_after` is None when waiting cannot help: the request needs more than it holds."""
+
+    def __init__(self, scope: str, dimension: str, retry_after: float | None):
+        self.scope = scope
+        self.dimension = dimension
+        self.retry_after = retry_after
+        kind, name = scope.split(":", 1)[0], dimension.replace('_', ' ')
+        if retry_after is None:
+            super().__init__(f"The request needs more {name} than the {kind} quota allows")
+        else:
+            super().__init__(f"The {kind} quota for {name} is used up; retry in {retry_after:.0f}s")
+
+
+def _refill(level: float, updated: float, bucket: Bucket, now: float) -> float:
+    return min(bucket.capacity, level + (now - updated) * bucket.per_minute / 60)
+
+
+def _retry_after(level: float, needed: float, bucket: Bucket) -> float | None:
+    if needed > bucket.capacity or bucket.per_minute <= 0:
+        return None
+    return min(3600.0, max(1.0, (needed - level) * 60 / bucket.per_minute))
+
+
+class InMemoryQuotaStore:
+    def __init__(self):
+        self._buckets: dict[tuple[str, str], tuple[float, float]] = {}
+        self._usage: dict[tuple[str, str], dict[str, float]] = {}
+
+    def _level(self, scope: str, dimension: str, bucket: Bucket, now: float) -> float:
+        level, updated = self._buckets.get((scope, dimension), (bucket.capacity, now))
+        return _refill(level, updated, bucket, now)
+
+    def _add_usage(self, scopes: list[str], day: str, counters: dict[str, float]):
+        for scope in scopes:
+            totals = self._usage.setdefault((scope, day), dict.fromkeys(USAGE_COUNTERS, 0))
+            for name, value in counters.items():
+                totals[name] += value
+
+    async def acquire(self, checks: list[tuple[str, str, float, float, Bucket]], scopes: list[str], day: str,
+                      counters: dict[str, float]):
+        """
+        checks: (scope, dimension, take, need, bucket). Takes `take` from every bucket and adds
+        `counters` to the day's usage of `scopes`, only if each bucket holds at least
+        max(take, need); otherwise changes nothing and returns the first short
+        (scope, dimension, retry_after).
+        """
+        now = time.time()
+        levels = [self._level(scope, dim, bucket, now) for scope, dim, _, _, bucket in checks]
+        for (scope, dim, take, need, bucket), level in zip(checks, levels):
+            if level < max(take, need):
+                return scope, dim, _retry_after(level, max(take, need), bucket)
+        for (scope, dim, take, _, _), level in zip(checks, levels):
+            self._buckets[(scope, dim)] = (level - take, now)
+        self._add_usage(scopes, day, counters)
+        return None
+
+    async def charge(self, charges: list[tuple[str, str, float, Bucket]], scopes: list[str], day: str,
+                     counters: dict[str, float]):
+        """
+        Take amounts unconditionally (a bucket may go negative; a negative amount refunds up
+        to capacity) and add `counters` to the day's usage.
+        """
+        now = time.time()
+        for scope, dim, amount, bucket in charges:
+            self._buckets[(scope, dim)] = (min(bucket.capacity, self._level(scope, dim, bucket, now) - amount), now)
+        self._add_usage(scopes, day, counters)
+
+    async def levels(self, scope: str, buckets: dict[str, Bucket]) -> dict[str, float]:
+        now = time.time()
+        return {dim: round(self._level(scope, dim, bucket, now), 2) for dim, bucket in buckets.items()}
+
+    async def usage(self, scope: str, days: list[str]) -> dict[str, dict[str, float]]:
+        return {day: dict(self._usage[(scope, day)]) for day in days if (scope, day) in self._usage}
+
+
+class SQLiteQuotaStore:
+    """Buckets and usage in a SQLite-WAL database shared by the workers on this host."""
+
+    def __init__(self, path: str = QUOTA_DB_PATH):
+        self.db = SQLiteDatabase(path, f"""
+            CREATE TABLE IF NOT EXISTS buckets (
+                scope TEXT NOT NULL, dimension TEXT NOT NULL, level REAL NOT NULL, updated REAL NOT NULL,
+                PRIMARY KEY (scope, dimension)
+            );
+            CREATE TABLE IF NOT EXISTS usage (
+                scope TEXT NOT NULL, day TEXT NOT NULL, {", ".join(f"{c} REAL NOT NULL DEFAULT 0" for c in USAGE_COUNTERS)},
+                PRIMARY KEY (scope, day)
+            );
+        """, "quota")
+
+    @staticmethod
+    def _level(conn, scope: str, dimension: str, bucket: Bucket, now: float) -> float:
+        row = conn.execute("SELECT level, updated FROM buckets WHERE scope = ? AND dimension = ?",
+                           (scope, dimension)).fetchone()
+        level, updated = row if row else (bucket.capacity, now)
+        return _refill(level, updated, bucket, now)
+
+    @staticmethod
+    def _add_usage(conn, scopes: list[str], day: str, counters: dict[str, float]):
+        names = [n for n in USAGE_COUNTERS if n in counters]
+        if not names:
+            return
+        sql = (f"INSERT INTO usage (scope, day, {', '.join(names)}) VALUES (?, ?, {', '.join('?' for _ in names)}) "
+               f"ON CONFLICT (scope, day) DO UPDATE SET {', '.join(f'{n} = {n} + excluded.{n}' for n in names)}")
+        conn.executemany(sql, [(scope, day, *(counters[n] for n in names)) for scope in scopes])
+
+    async def acquire(self, checks: list[tuple[str, str, float, float, Bucket]], scopes: list[str], day: str,
+                      counters: dict[str, float]):
+        now = time.time()
+
+        def run(conn):
+            levels = [self._level(conn, scope, dim, bucket, now) for scope, dim, _, _, bucket in checks]
+            for (scope, dim, take, need, bucket), level in zip(checks, levels):
+                if level < max(take, need):
+                    return scope, dim, _retry_after(level, max(take, need), bucket)
+            conn.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                             [(scope, dim, level - take, now) for (scope, dim, take, _, _), level in zip(checks, levels)])
+            self._add_usage(conn, scopes, day, counters)
+            return None
+        return await self.db.write(run)
+
+    async def charge(self, charges: list[tuple[str, str, float, Bucket]], scopes: list[str], day: str,
+                     counters: dict[str, float]):
+        now = time.time()
+
+        def run(conn):
+            rows = [(scope, dim, min(bucket.capacity, self._level(conn, scope, dim, bucket, now) - amount), now)
+                    for scope, dim, amount, bucket in charges]
+            conn.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", rows)
+            self._add_usage(conn, scopes, day, counters)
+        await self.db.write(run)
+
+    async def levels(self, scope: str, buckets: dict[str, Bucket]) -> dict[str, float]:
+        now = time.time()
+        return await self.db.read(
+            lambda conn: {dim: round(self._level(conn, scope, dim, bucket, now), 2) for dim, bucket in buckets.items()})
+
+    async def usage(self, scope: str, days: list[str]) -> dict[str, dict[str, float]]:
+        rows = await self.db.read(lambda conn: conn.execute(
+            f"SELECT day, {', '.join(USAGE_COUNTERS)} FROM usage WHERE scope = ? AND day IN ({', '.join('?' for _ in days)})",
+            (scope, *days)).fetchall())
+        return {row[0]: dict(zip(USAGE_COUNTERS, row[1:])) for row in rows}
+
+
+def make_store(kind: str = QUOTA_STORE):
+    if kind == "memory":
+        return InMemoryQuotaStore()
+    if kind != "sqlite":
+        raise ValueError(f"QUOTA_STORE must be 'sqlite' or 'memory', got '{kind}'")
+    try:
+        return SQLiteQuotaStore()
+    except sqlite3.Error as e:
+        logging.warning("[Quota] Could not open %s, using per-process quotas: %s", QUOTA_DB_PATH, e)
+        return InMemoryQuotaStore()
+
+
+store = make_store()
+
+
+class _Reservation:
+    """Budget an admitted request has taken ahead of its LLM calls, settled as they report usage."""
+
+    def __init__(self, user: str, tenant: str | None, calls: int, tokens: float):
+        self.user = user
+        self.tenant = tenant
+        self.calls = calls
+        self.tokens = tokens
+
+    @property
+    def scopes(self) -> list[str]:
+        return _scope_names(self.user, self.tenant)
+
+
+# Reservation of the request being served, set by admit(); shared by the request's agent tasks
+_reservation: ContextVar[_Reservation | None] = ContextVar("quota_reservation", default=None)
+
+
+def tenant_of(claims: dict | None) -> str | None:
+    """Descope tenant of a session: the current tenant if set, else the first one, else None."""
+    claims = claims or {}
+    return claims.get("dct") or next(iter(claims.get("tenants") or {}), None)
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+def planned_calls(agents: list[str], intent: str) -> int:
+    config = load_config()
+    if not agents:
+        return config.agent_calls.get(intent, 1)
+    return sum(config.agent_calls.get(agent, 1) for agent in agents)
+
+
+def _scope_names(user: str, tenant: str | None) -> list[str]:
+    # Users without a tenant are limited on their own, never pooled into a shared tenant bucket
+    return [f"user:{user}"] + ([f"tenant:{tenant}"] if tenant else [])
+
+
+def _scope_buckets(user: str, tenant: str | None):
+    config = load_config()
+    for scope in _scope_names(user, tenant):
+        for dim, bucket in (config.user if scope.startswith("user:") else config.tenant).items():
+            if bucket.capacity > 0:
+                yield scope, dim, bucket
+
+
+def cost_usd(model: str | None, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    price = load_config().prices_per_million_tokens.get(model or "")
+    if price is None:
+        return 0.0
+    return ((prompt_tokens - cached_tokens) * price.prompt + cached_tokens * price.cached
+            + completion_tokens * price.completion) / 1_000_000
+
+
+async def _acquire(user: str, tenant: str | None, take: dict[str, float], counters: dict[str, float]):
+    checks = [(scope, dim, take[dim], take[dim], bucket) for scope, dim, bucket in _scope_buckets(user, tenant) if dim in take]
+    denied = await store.acquire(checks, _scope_names(user, tenant) if counters else [], _today(), counters)
+    if denied:
+        scope, dim, retry_after = denied
+        metrics.inc("quota_rejected_total", scope=scope.split(":", 1)[0], dimension=dim)
+        logging.warning("[Quota] Rejected %s: %s quota exhausted", scope, dim)
+        raise QuotaExceeded(scope, dim, retry_after)
+
+
+async def admit(user: str, tenant: str | None):
+    """
+    Admit a request for the verified `user`/`tenant`: take one request plus one call's
+    estimated budget for its intent call. Raises QuotaExceeded, taking nothing, if a bucket
+    is short. On success, later reserve() and charge_call()s apply to these scopes.
+    """
+    if not QUOTAS_ENABLED:
+        return
+    estimate = load_config().estimated_tokens_per_call
+    await _acquire(user, tenant, {"requests": 1, "llm_calls": 1, "tokens": estimate}, {"requests": 1})
+    _reservation.set(_Reservation(user, tenant, 1, estimate))
+
+
+async def reserve(calls: int):
+    """
+    Take the estimated budget of `calls` more LLM calls for the admitted request, so
+    concurrent requests cannot all pass on the same budget. Raises QuotaExceeded, taking
+    nothing, if a bucket is short.
+    """
+    reservation = _reservation.get()
+    if reservation is None or calls <= 0:
+        return
+    estimate = calls * load_config().estimated_tokens_per_call
+    await _acquire(reservation.user, reservation.tenant, {"llm_calls": calls, "tokens": estimate}, {})
+    reservation.calls += calls
+    reservation.tokens += estimate
+
+
+async def wait_for(acquire):
+    """Await admit()/reserve() via `acquire`, sleeping out QuotaExceeded until it passes (batch runs)."""
+    while True:
+        try:
+            return await acquire()
+        except QuotaExceeded as e:
+            if e.retry_after is None:
+                raise
+            logging.info("[Quota] Waiting %.0fs for the %s %s quota", e.retry_after, e.scope.split(":", 1)[0], e.dimension)
+            metrics.observe("quota_wait_seconds", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+
+def begin_request():
+    """Forget the previous request's reservation (WebSocket turns share one context)."""
+    _reservation.set(None)
+
+
+async def _charge(reservation: _Reservation, amounts: dict[str, float], counters: dict[str, float]):
+    charges = [(scope, dim, amounts[dim], bucket) for scope, dim, bucket in _scope_buckets(reservation.user, reservation.tenant)
+               if amounts.get(dim)]
+    try:
+        await store.charge(charges, reservation.scopes if counters else [], _today(), counters)
+    except sqlite3.Error as e:
+        # Accounting must never fail the call that has already been paid for
+        logging.warning("[Quota] Could not record usage: %s", e)
+
+
+async def charge_call(entry: dict):
+    """
+    Settle one LLM call's actual usage against the current request's reservation: what it
+    covers is already taken, anything beyond it is charged (and may overdraw a bucket).
+    """
+    reservation = _reservation.get()
+    if reservation is None:
+        return
+    tokens = entry["prompt_tokens"] + entry["completion_tokens"]
+    covered_calls = min(reservation.calls, 1)
+    covered_tokens = min(reservation.tokens, tokens)
+    reservation.calls -= covered_calls
+    reservation.tokens -= covered_tokens
+    await _charge(reservation, {"llm_calls": 1 - covered_calls, "tokens": tokens - covered_tokens}, {
+        "llm_calls": 1,
+        "prompt_tokens": entry["prompt_tokens"],
+        "cached_tokens": entry["cached_tokens"],
+        "completion_tokens": entry["completion_tokens"],
+        "cost_usd": cost_usd(entry.get("model"), entry["prompt_tokens"], entry["cached_tokens"], entry["completion_tokens"]),
+    })
+
+
+async def finish_request():
+    """Refund whatever the request reserved but did not use, e.g. agents that were denied or failed."""
+    reservation = _reservation.get()
+    if reservation is None:
+        return
+    _reservation.set(None)
+    if reservation.calls or reservation.tokens:
+        await _charge(reservation, {"llm_calls": -reservation.calls, "tokens": -reservation.tokens}, {})
+
+
+async def usage_summary(user: str, tenant: str | None, days: int = 7) -> dict:
+    """Per-day usage and cost plus the current bucket levels for a user and their tenant."""
+    config = load_config()
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    day_keys = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(max(1, days))]
+    summary = {"tenant": None}
+    for kind, scope_id, buckets in (("user", user, config.user), ("tenant", tenant, config.tenant)):
+        if scope_id is None:
+            continue
+        scope = f"{kind}:{scope_id}"
+        limits = {dim: bucket for dim, bucket in buckets.items() if bucket.capacity > 0}
+        summary[kind] = {
+            "id": scope_id,
+            "usage": {day: {**totals, "cost_usd": round(totals["cost_usd"], 6)} for day, totals in (await store.usage(scope, day_keys)).items()},
+            "remaining": await store.levels(scope, limits),
+            "limits": {dim: bucket.model_dump() for dim, bucket in limits.items()},
+        }
+    return summary
@@ -0,0 +1,249 @@
+# backend/utils/resilience.py
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+import httpx
+import openai
+import requests
+from descope.exceptions import AuthException, RateLimitException, ERROR_TYPE_SERVER_ERROR
+from utils import metrics
+from utils.profiling import profile_span
+from utils.llm_cassette import raise_on_cassette_miss
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RECOVERY_SECONDS = float(os.getenv("BREAKER_RECOVERY_SECONDS", "30"))
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "2"))
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.2"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "2"))
+# The OpenAI client already retries internally, so LLM calls get fewer outer retries
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "1"))
+
+# Hedged LLM requests: off by default since a hedge can double the cost of a slow call
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "1"))
+HEDGE_MIN_SAMPLES = 20
+
+
+# What an agent answers with when its upstream is down, instead of an error string
+AGENT_UNAVAILABLE_MESSAGE = "The {agent} agent is temporarily unavailable, please try again shortly."
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream dependency is failing or its circuit breaker is open."""
+
+    def __init__(self, dependency: str, message: str = ""):
+        self.dependency = dependency
+        super().__init__(message or f"{dependency} is temporarily unavailable")
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+_FAILURE_STATUSES = (408, 429)
+
+
+def _is_failure_status(status) -> bool:
+    return status is not None and (status >= 500 or status in _FAILURE_STATUSES)
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """
+    True only for errors that mean the upstream itself is unhealthy: timeouts,
+    connection errors, and HTTP 5xx/408/429 from httpx, openai, requests or Descope.
+    Anything else (an invalid token, a 4xx, a bug in our own code) is a rejection
+    and never counts against the breaker.
+    """
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    if isinstance(e, (httpx.TransportError, openai.APIConnectionError,
+                      requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, (httpx.HTTPStatusError, requests.exceptions.HTTPError)):
+        return _is_failure_status(getattr(e.response, "status_code", None))
+    if isinstance(e, openai.APIStatusError):
+        return _is_failure_status(e.status_code)
+    if isinstance(e, RateLimitException):
+        return True
+    if isinstance(e, AuthException):
+        # Descope reports malformed or badly signed tokens as status 500 "invalid token"
+        return e.error_type == ERROR_TYPE_SERVER_ERROR and _is_failure_status(e.status_code)
+    return False
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive failures. After
+    `recovery_seconds` one trial call is let through (half-open); its success
+    closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 recovery_seconds: float = BREAKER_RECOVERY_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        metrics.set_gauge("circuit_breaker_state", _STATE_VALUES[CLOSED], dependency=name)
+
+    def _transition(self, new_state: str):
+        if new_state == self.state:
+            return
+        logging.warning("[Resilience] Circuit '%s' %s -> %s", self.name, self.state, new_state)
+        metrics.inc("circuit_breaker_transitions_total", dependency=self.name, from_state=self.state, to_state=new_state)
+        metrics.set_gauge("circuit_breaker_state", _STATE_VALUES[new_state], dependency=self.name)
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = time.monotonic()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must not go through."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_seconds:
+            self._transition(HALF_OPEN)
+        if self.state == OPEN or (self.state == HALF_OPEN and self._trial_in_flight):
+            metrics.inc("circuit_breaker_rejected_total", dependency=self.name)
+            raise CircuitOpenError(self.name)
+        if self.state == HALF_OPEN:
+            self._trial_in_flight = True
+
+    def release(self):
+        """Give back a half-open trial slot without recording an outcome."""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self._trial_in_flight = False
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._transition(OPEN)
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies of one kind of call, used to pick its hedge delay."""
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def p95(self) -> float | None:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_latencies: dict[str, LatencyTracker] = {}
+
+
+def get_breaker(dependency: str) -> CircuitBreaker:
+    if dependency not in _breakers:
+        _breakers[dependency] = CircuitBreaker(dependency)
+    return _breakers[dependency]
+
+
+def get_latency_tracker(key: str) -> LatencyTracker:
+    if key not in _latencies:
+        _latencies[key] = LatencyTracker()
+    return _latencies[key]
+
+
+async def _hedged(dependency: str, call, tracker: LatencyTracker):
+    """Start `call`; if it has not finished by the p95 latency, start a second one and take the first success."""
+    p95 = tracker.p95()
+    delay = max(p95 or 0, HEDGE_MIN_DELAY_SECONDS)
+    first = asyncio.ensure_future(call())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+
+    metrics.inc("hedged_requests_total", dependency=dependency)
+    pending = {first, asyncio.ensure_future(call())}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        metrics.inc("hedged_requests_won_total", dependency=dependency)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_resilience(dependency: str, call, retries: int = RETRY_ATTEMPTS,
+                               is_failure=is_upstream_failure, hedge: bool = False, latency_key: str | None = None):
+    """
+    Run `call` (a zero-arg coroutine function) behind the dependency's circuit
+    breaker with bounded, fully jittered exponential-backoff retries. Latencies
+    (and so hedge delays) are tracked per `latency_key`, default the dependency,
+    so calls of very different lengths do not share one p95.
+
+    Errors for which `is_failure` is False (e.g. a 401 or an invalid token) are
+    re-raised untouched and neither count against nor reset the breaker. Upstream failures raise UpstreamUnavailable
+    once retries are exhausted, or immediately while the breaker is open.
+    """
+    breaker = get_breaker(dependency)
+    tracker = get_latency_tracker(latency_key or dependency)
+    for attempt in range(retries + 1):
+        breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = await (_hedged(dependency, call, tracker) if hedge else call())
+        except asyncio.CancelledError:
+            # Free the half-open trial slot, otherwise the breaker would never close again
+            breaker.release()
+            raise
+        except Exception as e:
+            if not is_failure(e):
+                # A rejection says nothing about the upstream's health (it may not even have been contacted)
+                breaker.release()
+                raise
+            breaker.record_failure()
+            metrics.inc("upstream_failures_total", dependency=dependency)
+            if attempt == retries or breaker.state == OPEN:
+                raise UpstreamUnavailable(dependency, f"{dependency} is temporarily unavailable: {e}") from e
+            delay = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+            logging.warning("[Resilience] %s call failed (%s); retry %d/%d in %.2fs", dependency, e, attempt + 1, retries, delay)
+            metrics.inc("upstream_retries_total", dependency=dependency)
+            await asyncio.sleep(delay)
+            continue
+        elapsed = time.perf_counter() - start
+        breaker.record_success()
+        tracker.record(elapsed)
+        metrics.observe("upstream_latency_seconds", elapsed, dependency=dependency)
+        return result
+
+
+async def call_llm(runnable, inputs, hedge: bool | None = None, name: str = "llm", tier: str | None = None):
+    """
+    ainvoke a chat model or chain through the shared OpenAI breaker, with latencies tracked
+    per call name and model tier. Raises CassetteMiss on a strict-mode replay miss.
+    """
+    with profile_span("llm", name):
+        try:
+            return await call_with_resilience("openai", lambda: runnable.ainvoke(inputs), retries=LLM_RETRY_ATTEMPTS,
+                                              hedge=LLM_HEDGING if hedge is None else hedge,
+                                              latency_key=f"openai:{name}:{tier}" if tier else f"openai:{name}")
+        except openai.NotFoundError as e:
+            raise_on_cassette_miss(e)
+            raise
@@ -0,0 +1,92 @@
+# backend/utils/response_utils.py
+from pydantic import BaseModel
+from typing import Iterable, Optional
+
+# Fields returned when the client does not ask for anything else
+DEFAULT_FIELDS = ("user_id", "message", "intent", "agents")
+
+# Every field a client may opt into via `fields=`; internal state such as
+# fitbit_token is never exposed regardless of the mask
+RESPONSE_FIELDS = (
+    "user_id",
+    "message",
+    "intent",
+    "agents",
+    "consent_required",
+    "trainer_response",
+    "nutrition_response",
+    "recovery_response",
+    "invocation_log",
+    "chat_history",
+    "manual_data",
+    "fitbit_metrics",
+    "usage",
+)
+
+# Fitbit keys that live in state but are credentials/flags, not metrics
+_FITBIT_PRIVATE_KEYS = {"fitbit_token", "fitbit_linked"}
+
+
+class AgentQueryResponse(BaseModel):
+    """Response schema for /agent_query. Only the masked fields are sent, so every field is optional."""
+    user_id: Optional[str] = None
+    message: Optional[str] = None
+    intent: Optional[str] = None
+    agents: Optional[list[str]] = None
+    consent_required: Optional[bool] = None
+    trainer_response: Optional[str] = None
+    nutrition_response: Optional[str] = None
+    recovery_response: Optional[str] = None
+    invocation_log: Optional[list[str]] = None
+    chat_history: Optional[list[dict]] = None
+    manual_data: Optional[dict] = None
+    fitbit_metrics: Optional[dict] = None
+    usage: Optional[list[dict]] = None  # per LLM call: agent, tier, prompt/cached/completion tokens, prompt sections
+
+
+def parse_fields(raw) -> tuple[str, ...]:
+    """
+    Parse a field mask given as "a,b,c", a list of names, or "*" for every field.
+    Unknown names are ignored; an empty/missing mask falls back to DEFAULT_FIELDS.
+    """
+    if not raw:
+        return DEFAULT_FIELDS
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    names = [str(name).strip() for name in raw if str(name).strip()]
+    if "*" in names:
+        return RESPONSE_FIELDS
+    selected = tuple(name for name in RESPONSE_FIELDS if name in names)
+    return selected or DEFAULT_FIELDS
+
+
+def _field_value(name: str, state: dict):
+    if name == "fitbit_metrics":
+        metrics = {
+            k[len("fitbit_"):]: v for k, v in state.items()
+            if k.startswith("fitbit_") and k not in _FITBIT_PRIVATE_KEYS
+        }
+        return metrics or None
+    if name == "usage":
+        return state.get("llm_usage") or None
+    if name == "manual_data":
+        manual = {k: v for k, v in state.items() if k.startswith("manual_")}
+        return manual or None
+    return state.get(name)
+
+
+def build_agent_response(user_id: str, message: str, intent: str, state: dict,
+                         agents: Iterable[str] = (), fields: Iterable[str] = DEFAULT_FIELDS, **extra) -> dict:
+    """
+    Build the /agent_query payload containing only the requested fields.
+    Fields that are unset in state are omitted rather than sent as null; `extra`
+    keys (e.g. consent_required) are always included.
+    """
+    base = {"user_id": user_id, "message": message, "intent": intent, "agents": list(agents)}
+    payload = {}
+    for name in fields:
+        value = base[name] if name in base else _field_value(name, state)
+        if value is not None:
+            payload[name] = value
+    payload.update(extra)
+    return payload
@@ -0,0 +1,69 @@
+# backend/utils/session_store.py
+import os
+import time
+import logging
+from typing import Iterable
+from utils.shared_cache import get_cache
+
+# How long a consent grant stays valid unless the client asks for a shorter TTL
+CONSENT_TTL_SECONDS = int(os.getenv("CONSENT_TTL_SECONDS", str(30 * 24 * 3600)))
+
+
+class SessionStore:
+    """
+    Per-user session data kept by the orchestrator: chat state and consent grants.
+
+    Consent grants are stored per user and per agent as an expiry timestamp, so a
+    check for a flow of agents is a handful of dict lookups. They live in the shared
+    cache, so a grant made through one worker is honoured by the others.
+    """
+
+    def __init__(self):
+        self.user_states: dict[str, dict] = {}
+        self._consents = get_cache("consent", default_ttl=CONSENT_TTL_SECONDS)
+
+    async def _save(self, user_id: str, grants: dict[str, float]):
+        if grants:
+            await self._consents.set(user_id, grants, ttl=max(grants.values()) - time.time())
+        else:
+            await self._consents.delete(user_id)
+
+    async def grant_consent(self, user_id: str, agents: Iterable[str], ttl_seconds: int | None = None) -> float:
+        """Record consent for the given agents. Returns the expiry timestamp."""
+        ttl = CONSENT_TTL_SECONDS if ttl_seconds is None else min(ttl_seconds, CONSENT_TTL_SECONDS)
+        expires_at = time.time() + ttl
+        agents = list(agents)
+        grants = await self.list_consents(user_id)
+        for agent in agents:
+            grants[agent] = expires_at
+        await self._save(user_id, grants)
+        logging.info("[Consent] Granted for user %s: %s", user_id, agents)
+        return expires_at
+
+    async def revoke_consent(self, user_id: str, agents: Iterable[str] | None = None) -> None:
+        """Revoke consent for the given agents, or every agent if none are given."""
+        if agents is None:
+            await self._consents.delete(user_id)
+        else:
+            agents = list(agents)
+            grants = await self.list_consents(user_id)
+            for agent in agents:
+                grants.pop(agent, None)
+            await self._save(user_id, grants)
+        logging.info("[Consent] Revoked for user %s: %s", user_id, "all" if agents is None else agents)
+
+    async def has_consent(self, user_id: str, agents: Iterable[str]) -> bool:
+        """True if every agent in the set has an unexpired grant for this user."""
+        grants = await self._consents.get(user_id)
+        if not grants:
+            return False
+        now = time.time()
+        return all(grants.get(agent, 0) > now for agent in agents)
+
+    async def list_consents(self, user_id: str) -> dict[str, float]:
+        """Unexpired grants for a user as {agent: expires_at}."""
+        now = time.time()
+        return {agent: exp for agent, exp in ((await self._consents.get(user_id)) or {}).items() if exp > now}
+
+
+session_store = SessionStore()
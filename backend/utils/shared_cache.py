@@ -0,0 +1,299 @@
+# backend/utils/shared_cache.py
+"""
+Two-level cache shared by the uvicorn workers on one host.
+
+    level 1  per-process LRU (OrderedDict), no I/O
+    level 2  SQLite database in WAL mode at SHARED_CACHE_PATH, shared by every
+             worker and kept across restarts
+
+Modules get a namespaced cache with get_cache("claims", ...) and await its
+get/set/delete; level-2 I/O runs on the database's own thread (SQLiteDatabase),
+never on the event loop. Values are stored as a versioned orjson envelope, so they must
+be JSON-serializable (tuples come back as lists) and read the same in every
+worker and across deploys. Values returned from the LRU are shared, so treat
+them as read-only and set() a copy to change one.
+
+Writes and deletes are broadcast through an invalidations table: each worker
+polls it at most every SHARED_CACHE_POLL_SECONDS (on access, no background
+thread) and drops the affected keys from its LRU, so a peer's local copy is
+stale for at most that long. Set SHARED_CACHE_PATH=off to run local-only.
+Hits and misses are counted per namespace and level in the
+cache_requests_total metric.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from utils import metrics
+
+SHARED_CACHE_PATH = os.getenv(
+    "SHARED_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "shared_cache.db"),
+)
+SHARED_CACHE_POLL_SECONDS = float(os.getenv("SHARED_CACHE_POLL_SECONDS", "1"))
+SHARED_CACHE_LOCAL_MAX = int(os.getenv("SHARED_CACHE_LOCAL_MAX", "1024"))
+# Invalidation rows older than this are pruned; a worker that sleeps longer drops its whole LRU
+INVALIDATION_RETENTION_SECONDS = 3600
+_PURGE_EVERY_WRITES = 500
+
+FORMAT_VERSION = 1
+_MISSING = object()
+
+
+def dumps(value) -> bytes:
+    return bytes([FORMAT_VERSION]) + orjson.dumps(value)
+
+
+def loads(data: bytes):
+    if not data or data[0] != FORMAT_VERSION:
+        raise ValueError("Unknown shared cache format version")
+    return orjson.loads(data[1:])
+
+
+class SQLiteDatabase:
+    """
+    A SQLite database in WAL mode shared by the workers on this host. The shared
+    cache tier and the idempotency and quota stores each open one.
+
+    Statements run on the database's own thread, never on the event loop: a write
+    can wait up to `timeout` seconds for another worker's lock. One thread per
+    database also serializes use of its connection, so no lock is needed.
+    """
+
+    def __init__(self, path: str, schema: str, name: str, timeout: float = 5):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(schema)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{name}")
+
+    def query_blocking(self, sql: str, params: tuple = ()) -> list:
+        """Run a query on the calling thread; only for startup, before the event loop uses the database."""
+        return self._conn.execute(sql, params).fetchall()
+
+    def _transaction(self, fn):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(self._conn)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return result
+
+    async def read(self, fn):
+        """Await fn(connection) run on the database thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, self._conn)
+
+    async def write(self, fn):
+        """Await fn(connection) run on the database thread inside a BEGIN IMMEDIATE transaction."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._transaction, fn)
+
+
+class SharedTier:
+    """The cache's SQLite tier."""
+
+    def __init__(self, path: str = SHARED_CACHE_PATH):
+        self.path = path
+        self.db = SQLiteDatabase(path, """
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE TABLE IF NOT EXISTS invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT, at REAL NOT NULL
+            );
+        """, "cache")
+        # Both only touched on the database thread
+        self._writes = 0
+        # Invalidations this process wrote itself, skipped when polling
+        self._own_ids: set[int] = set()
+        self.last_invalidation_id = self.db.query_blocking("SELECT COALESCE(MAX(id), 0) FROM invalidations")[0][0]
+
+    async def get(self, namespace: str, key: str):
+        row = await self.db.read(lambda conn: conn.execute(
+            "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone())
+        if row is None or row[1] <= time.time():
+            return _MISSING, 0.0
+        return loads(row[0]), row[1]
+
+    def _broadcast(self, conn, namespace: str, key: str | None):
+        cursor = conn.execute("INSERT INTO invalidations (namespace, key, at) VALUES (?, ?, ?)", (namespace, key, time.time()))
+        self._own_ids.add(cursor.lastrowid)
+
+    async def set(self, namespace: str, key: str, value, expires_at: float):
+        data = dumps(value)
+
+        def run(conn):
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (namespace, key, data, expires_at))
+            self._broadcast(conn, namespace, key)
+            self._writes += 1
+            if self._writes % _PURGE_EVERY_WRITES == 0:
+                self._purge(conn)
+        await self.db.write(run)
+
+    async def delete(self, namespace: str, key: str | None = None):
+        """Delete one key, or the whole namespace when key is None, and broadcast it."""
+        def run(conn):
+            if key is None:
+                conn.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+            else:
+                conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+            self._broadcast(conn, namespace, key)
+        await self.db.write(run)
+
+    async def invalidations_since(self, last_id: int) -> tuple[int, list[tuple[str, str | None]], bool]:
+        """
+        Invalidations after `last_id` as (new last id, [(namespace, key)], gap). `gap` is
+        True when rows the caller never saw were already pruned, so its LRU must be dropped.
+        """
+        def run(conn):
+            oldest = conn.execute("SELECT MIN(id) FROM invalidations").fetchone()[0]
+            rows = conn.execute("SELECT id, namespace, key FROM invalidations WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+            gap = oldest is not None and oldest > last_id + 1
+            foreign = [(ns, key) for row_id, ns, key in rows if row_id not in self._own_ids]
+            self._own_ids.difference_update(row_id for row_id, _, _ in rows)
+            return (rows[-1][0] if rows else last_id), foreign, gap
+        return await self.db.read(run)
+
+    def _purge(self, conn):
+        now = time.time()
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        conn.execute("DELETE FROM invalidations WHERE at < ?", (now - INVALIDATION_RETENTION_SECONDS,))
+
+
+class TwoLevelCache:
+    def __init__(self, namespace: str, shared: SharedTier | None, local_max: int = SHARED_CACHE_LOCAL_MAX,
+                 default_ttl: float = 300):
+        self.namespace = namespace
+        self.shared = shared
+        self.local_max = local_max
+        self.default_ttl = default_ttl
+        self._local: OrderedDict[str, tuple[object, float]] = OrderedDict()
+        self.stats = {"local_hit": 0, "local_miss": 0, "shared_hit": 0, "shared_miss": 0}
+
+    def _count(self, level: str, result: str):
+        self.stats[f"{level}_{result}"] += 1
+        metrics.inc("cache_requests_total", cache=self.namespace, level=level, result=result)
+
+    def _store_local(self, key: str, value, expires_at: float):
+        self._local[key] = (value, expires_at)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str, default=None):
+        await _sync_invalidations()
+        now = time.time()
+        entry = self._local.get(key)
+        if entry is not None and entry[1] > now:
+            self._local.move_to_end(key)
+            self._count("local", "hit")
+            return entry[0]
+        if entry is not None:
+            del self._local[key]
+        self._count("local", "miss")
+        if self.shared is None:
+            return default
+
+        try:
+            value, expires_at = await self.shared.get(self.namespace, key)
+        except (sqlite3.Error, ValueError) as e:
+            logging.warning("[SharedCache] Read of %s failed: %s", self.namespace, e)
+            return default
+        if value is _MISSING:
+            self._count("shared", "miss")
+            return default
+        self._count("shared", "hit")
+        self._store_local(key, value, expires_at)
+        return value
+
+    async def set(self, key: str, value, ttl: float | None = None):
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        self._store_local(key, value, expires_at)
+        if self.shared is not None:
+            try:
+                await self.shared.set(self.namespace, key, value, expires_at)
+            except (sqlite3.Error, TypeError) as e:
+                logging.warning("[SharedCache] Write to %s failed: %s", self.namespace, e)
+
+    async def delete(self, key: str):
+        self._local.pop(key, None)
+        if self.shared is not None:
+            try:
+                await self.shared.delete(self.namespace, key)
+            except sqlite3.Error as e:
+                logging.warning("[SharedCache] Delete in %s failed: %s", self.namespace, e)
+
+    async def clear(self):
+        self._local.clear()
+        if self.shared is not None:
+            try:
+                await self.shared.delete(self.namespace)
+            except sqlite3.Error as e:
+                logging.warning("[SharedCache] Clear of %s failed: %s", self.namespace, e)
+
+    def invalidate_local(self, key: str | None = None):
+        if key is None:
+            self._local.clear()
+        else:
+            self._local.pop(key, None)
+
+
+_shared: SharedTier | None = None
+_shared_opened = False
+_caches: dict[str, TwoLevelCache] = {}
+_last_poll = 0.0
+
+
+def get_shared_tier() -> SharedTier | None:
+    """The process-wide SQLite tier, opened on first use; None when disabled or unavailable."""
+    global _shared, _shared_opened
+    if not _shared_opened:
+        _shared_opened = True
+        if SHARED_CACHE_PATH.lower() not in ("", "off", "none"):
+            try:
+                _shared = SharedTier(SHARED_CACHE_PATH)
+            except sqlite3.Error as e:
+                logging.warning("[SharedCache] Could not open %s, using per-process caches only: %s", SHARED_CACHE_PATH, e)
+    return _shared
+
+
+def get_cache(namespace: str, local_max: int = SHARED_CACHE_LOCAL_MAX, default_ttl: float = 300) -> TwoLevelCache:
+    if namespace not in _caches:
+        _caches[namespace] = TwoLevelCache(namespace, get_shared_tier(), local_max, default_ttl)
+    return _caches[namespace]
+
+
+async def _sync_invalidations():
+    """Apply invalidations broadcast by other workers (and ourselves) since the last poll."""
+    global _last_poll
+    shared = _shared
+    now = time.monotonic()
+    if shared is None or now - _last_poll < SHARED_CACHE_POLL_SECONDS:
+        return
+    _last_poll = now
+    try:
+        last_id, rows, gap = await shared.invalidations_since(shared.last_invalidation_id)
+    except sqlite3.Error as e:
+        logging.warning("[SharedCache] Invalidation poll failed: %s", e)
+        return
+    shared.last_invalidation_id = last_id
+    if gap:
+        for cache in _caches.values():
+            cache.invalidate_local()
+        return
+    for namespace, key in rows:
+        cache = _caches.get(namespace)
+        if cache is not None:
+            cache.invalidate_local(key)
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    return {namespace: dict(cache.stats) for namespace, cache in _caches.items()}